@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from types import SimpleNamespace
+
+# Run against a throwaway data directory so the real users, admins and states are never touched
+data_dir = tempfile.mkdtemp(prefix='lumia_bench_')
+os.environ['DATA_DIR'] = data_dir
+os.environ['USER_STORE_PATH'] = f'{data_dir}/users.db'
+os.environ.setdefault('API_TOKEN', '0:benchmark')
+for channel in ('FIRMWARE_CHANNEL', 'EMERGENCY_CHANNEL', 'UPLOAD_CHANNEL', 'REQUEST_CHANNEL', 'UNBLOCK_CHANNEL'):
+    os.environ.setdefault(channel, '0')
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, current_dir)
+
+import lumia_firmware_download_bot as lfdb  # noqa: E402
+from catalog_compiler import compile_catalog, file_digest  # noqa: E402
+
+# Blocked users get a reply; keep the benchmarks off the network
+lfdb.bot.reply_to = lambda *args, **kwargs: None
+
+
+def measure(function, repeat, min_time=0.05):
+    """Return per-call timings in microseconds, one per repeat, each averaged over enough calls to take min_time."""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+
+    timings = [elapsed / number * 1e6]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - started) / number * 1e6)
+    return timings, number
+
+
+def synthetic_devices(scale):
+    """devices.json repeated `scale` times, with product types and codes suffixed to stay unique."""
+    with open(f'{current_dir}/devices.json', 'r') as json_file:
+        devices = json.load(json_file)
+
+    result = []
+    for copy_number in range(scale):
+        suffix = f"-X{copy_number}" if copy_number else ""
+        for device in devices:
+            result.append(dict(device, ProductType=device['ProductType'] + suffix,
+                               ProductCodes=[dict(entry, ProductCode=entry['ProductCode'] + suffix)
+                                             for entry in device['ProductCodes']]))
+    return result
+
+
+def synthetic_users(count):
+    users = [{'UserID': user_id, 'Fullname': f"User {user_id}", 'Username': f"@user{user_id}", 'Bot': False,
+              'TotalRequests': user_id % 3, 'LastRequested': "2024-01-01 00:00:00"}
+             for user_id in range(1, count + 1)]
+    admins = [{'UserID': user['UserID'], 'Fullname': user['Fullname'], 'Username': user['Username']}
+              for user in users[::100]]
+    blocked = [{'UserID': user['UserID'] + 1, 'Fullname': user['Fullname'], 'Username': user['Username'],
+                'Reason': "Benchmark"} for user in users[::20]]
+    return users, admins, blocked
+
+
+def use_user_store(backend, users, admins, blocked):
+    """Point the bot at a fresh user store of the given backend, filled with the given records."""
+    lfdb.json_writer.flush()
+    for file_name in list(lfdb.USER_TABLES.values()) + ['users.db', 'users.db-wal', 'users.db-shm']:
+        if os.path.exists(f'{data_dir}/{file_name}'):
+            os.remove(f'{data_dir}/{file_name}')
+
+    if backend == 'json':
+        lfdb.user_store = lfdb.JsonUserStore()
+    else:
+        lfdb.user_store = lfdb.SqliteUserStore(f'{data_dir}/users.db')
+    lfdb.user_store.upsert_many('users', users)
+    lfdb.user_store.upsert_many('admins', admins)
+    lfdb.user_store.upsert_many('blocked', blocked)
+    lfdb.json_writer.flush()
+
+    lfdb.acl = lfdb.AccessControl()
+    lfdb.quotas = lfdb.QuotaEngine(lfdb.QUOTA_LIMITS, lfdb.QUOTA_WINDOW, 3600)
+
+
+def run(user_counts, catalog_scales, backends, repeat):
+    results = {}
+    rng = random.Random(0)
+
+    def record(name, dataset, function):
+        timings, number = measure(function, repeat)
+        results[f"{name}[{dataset}]"] = {
+            'benchmark': name,
+            'dataset': dataset,
+            'calls_per_repeat': number,
+            'min_us': round(min(timings), 3),
+            'median_us': round(statistics.median(timings), 3),
+            'ops_per_sec': round(1e6 / statistics.median(timings), 1),
+        }
+        print(f"{name:<24} {dataset:<26} {statistics.median(timings):>12.2f} us", file=sys.stderr)
+
+    for count in user_counts:
+        users, admins, blocked = synthetic_users(count)
+        user_ids = [rng.randint(1, count + 1) for _ in range(1024)]
+        messages = [SimpleNamespace(from_user=SimpleNamespace(id=user_id)) for user_id in user_ids]
+        user_infos = [SimpleNamespace(id=user_id) for user_id in user_ids]
+
+        dataset = f"users={count}"
+        record('dump_json', dataset, lambda: (lfdb.dump_json('bench_users.json', users), lfdb.json_writer.flush()))
+        record('load_json', dataset, lambda: lfdb.load_json('bench_users.json'))
+
+        for backend in backends:
+            use_user_store(backend, users, admins, blocked)
+            dataset = f"users={count},store={backend}"
+            cycle = iter(range(1 << 62))
+
+            record('check_user_limit', dataset,
+                   lambda: lfdb.check_user_limit(user_infos[next(cycle) & 1023]))
+            record('is_user_blocked', dataset,
+                   lambda: lfdb.is_user_blocked(messages[next(cycle) & 1023]))
+            record('is_user_admin_by_id', dataset,
+                   lambda: lfdb.is_user_admin_by_id(user_ids[next(cycle) & 1023]))
+            record('user_store_get', dataset,
+                   lambda: lfdb.user_store.get('users', user_ids[next(cycle) & 1023]))
+
+    for scale in catalog_scales:
+        devices = synthetic_devices(scale)
+        with open(f'{data_dir}/devices.json', 'w') as json_file:
+            json.dump(devices, json_file, indent=4)
+
+        codes = [entry['ProductCode'].lower() for device in devices for entry in device['ProductCodes']]
+        codes = [rng.choice(codes) for _ in range(1024)]
+        cycle = iter(range(1 << 62))
+
+        for catalog_format in ('json', 'compiled'):
+            if catalog_format == 'compiled':
+                stat = os.stat(f'{data_dir}/devices.json')
+                with open(f'{data_dir}/devices.bin', 'wb') as catalog_file:
+                    catalog_file.write(compile_catalog(devices, (stat.st_mtime_ns, stat.st_size),
+                                                      file_digest(f'{data_dir}/devices.json')))
+
+            catalog = lfdb.DeviceCatalog('devices.json', check_interval=0, compiled_name='devices.bin')
+            lfdb.catalog = catalog
+            dataset = (f"catalog={scale}x,codes={sum(len(device['ProductCodes']) for device in devices)},"
+                       f"format={catalog_format}")
+
+            def reload_catalog():
+                catalog._signature = None
+                catalog._next_check = 0
+                catalog.current_version()
+
+            record('catalog_reload', dataset, reload_catalog)
+            catalog.check_interval = 1.0
+            record('resolve_product_code', dataset,
+                   lambda: catalog.product_code(codes[next(cycle) & 1023].upper()))
+
+        os.remove(f'{data_dir}/devices.bin')
+
+        # Exact, prefix, fuzzy and multi-word queries, against the index of the catalog just loaded
+        queries = ['lumia', 'lumia 640', 'rm-10', 'lumai', 'emea', 'dula sim', codes[0][:4]]
+        lfdb.search_index = lfdb.SearchIndex()
+        lfdb.search_index.search('lumia')
+        record('search', f"catalog={scale}x",
+               lambda: lfdb.search_index.search(queries[next(cycle) % len(queries)]))
+
+        record('download_stats_record', f"catalog={scale}x",
+               lambda: lfdb.download_stats.record('code', codes[next(cycle) & 1023]))
+        # Drop the synthetic counts, which would otherwise be flushed at exit into a removed data directory
+        lfdb.download_stats._pending.clear()
+
+    return results
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=current_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_file):
+    with open(baseline_file, 'r') as json_file:
+        baseline = json.load(json_file)['results']
+
+    print(f"{'benchmark':<52} {'baseline us':>12} {'current us':>12} {'change':>8}", file=sys.stderr)
+    for key, result in results.items():
+        if key in baseline:
+            before, after = baseline[key]['median_us'], result['median_us']
+            print(f"{key:<52} {before:>12.2f} {after:>12.2f} {(after - before) / before:>+8.1%}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the bot's hot paths against synthetic data sets.")
+    parser.add_argument('--users', default='1000,10000,100000', help="comma separated user counts")
+    parser.add_argument('--catalog', default='1,2,10', help="comma separated devices.json multipliers")
+    parser.add_argument('--backends', default='sqlite,json', help="comma separated user store backends")
+    parser.add_argument('--repeat', type=int, default=5, help="timed repeats per benchmark")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    try:
+        results = run([int(count) for count in args.users.split(',') if count],
+                      [int(scale) for scale in args.catalog.split(',') if scale],
+                      [backend for backend in args.backends.split(',') if backend], args.repeat)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump(report, json_file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
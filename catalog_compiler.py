@@ -0,0 +1,271 @@
+"""Compile devices.json into the binary catalog the bot memory-maps instead of parsing JSON.
+
+Usage: python catalog_compiler.py [devices.json] [devices.bin]
+
+Layout (little-endian):
+    header          magic, format version, section counts, the source file's (mtime_ns, size) and SHA-256
+    string offsets  uint32 per interned string, plus one end offset
+    devices         fixed-width records: ProductType, ModelName, emergency DownloadID, first code, code count,
+                    number of codes with a DownloadID
+    codes           fixed-width records: ProductCode, PackageTitle, Firmware, OS, device, first ID, ID count
+    download IDs    int64 per DownloadID
+    type index      device numbers sorted by ProductType, first occurrence of each type only
+    code index      code numbers sorted by ProductCode, first occurrence of each code only
+    string data     UTF-8 bytes of every distinct string, each stored once
+"""
+import os
+import sys
+import json
+import hashlib
+import mmap
+import struct
+
+MAGIC = b'LUMIACAT'
+FORMAT_VERSION = 2
+
+HEADER = struct.Struct('<8sIIIIIIIqq32s')
+DEVICE = struct.Struct('<IIqIII')
+CODE = struct.Struct('<IIIIIII')
+UINT32 = struct.Struct('<I')
+INT64 = struct.Struct('<q')
+
+NO_STRING = 0xFFFFFFFF
+NO_DOWNLOAD = -1
+
+
+def file_digest(path):
+    with open(path, 'rb') as source_file:
+        return hashlib.sha256(source_file.read()).digest()
+
+
+def compile_catalog(devices, source_signature=(0, 0), source_digest=bytes(32)):
+    """Return the binary catalog for a parsed devices.json as bytes."""
+    strings = {}
+
+    def intern(value):
+        if value is None:
+            return NO_STRING
+        return strings.setdefault(value, len(strings))
+
+    device_records = []
+    code_records = []
+    download_ids = []
+    for device_number, device in enumerate(devices):
+        emergency_id = device['Emergency']['DownloadID']
+        device_records.append((intern(device['ProductType']), intern(device['ModelName']),
+                               NO_DOWNLOAD if emergency_id is None else emergency_id,
+                               len(code_records), len(device['ProductCodes']),
+                               sum(1 for entry in device['ProductCodes'] if entry['DownloadID'])))
+        for entry in device['ProductCodes']:
+            code_records.append((intern(entry['ProductCode']), intern(entry['PackageTitle']),
+                                 intern(entry['Firmware']), intern(entry['OS']), device_number,
+                                 len(download_ids), len(entry['DownloadID'])))
+            download_ids.extend(entry['DownloadID'])
+
+    def sorted_index(records):
+        # Lookups match the JSON catalog, where the first record with a key wins
+        first = {}
+        for number, record in enumerate(records):
+            first.setdefault(record[0], number)
+        encoded = [value.encode() for value in strings]
+        return [number for _, number in sorted((encoded[key], number) for key, number in first.items())]
+
+    type_index = sorted_index(device_records)
+    code_index = sorted_index(code_records)
+
+    blob = bytearray()
+    offsets = []
+    for value in strings:
+        offsets.append(len(blob))
+        blob += value.encode()
+    offsets.append(len(blob))
+
+    parts = [HEADER.pack(MAGIC, FORMAT_VERSION, len(strings), len(device_records), len(code_records),
+                         len(download_ids), len(type_index), len(code_index), *source_signature,
+                         source_digest)]
+    parts += [UINT32.pack(offset) for offset in offsets]
+    parts += [DEVICE.pack(*record) for record in device_records]
+    parts += [CODE.pack(*record) for record in code_records]
+    parts += [INT64.pack(download_id) for download_id in download_ids]
+    parts += [UINT32.pack(number) for number in type_index + code_index]
+    parts.append(bytes(blob))
+    return b''.join(parts)
+
+
+class CompiledCatalog:
+    """Read-only view of a compiled catalog, decoded on demand from a memory map.
+
+    Opening one only reads the header. Lookups binary search the sorted indexes, and decoded
+    devices and found keys are kept, so repeated lookups are dict hits returning the same dicts,
+    shaped like devices.json. The download lists are read from the fixed-width records without
+    decoding any device.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as catalog_file:
+            self._map = mmap.mmap(catalog_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size:
+            raise ValueError(f"{path} is truncated")
+
+        (magic, version, string_count, device_count, code_count, download_count, type_count, code_index_count,
+         source_mtime, source_size, source_digest) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} compiled catalog")
+
+        self.source_signature = (source_mtime, source_size)
+        self.source_digest = source_digest
+        self.device_count = device_count
+        self._strings = HEADER.size
+        self._devices = self._strings + UINT32.size * (string_count + 1)
+        self._codes = self._devices + DEVICE.size * device_count
+        self._download_ids = self._codes + CODE.size * code_count
+        self._type_index = self._download_ids + INT64.size * download_count
+        self._type_count = type_count
+        self._code_index = self._type_index + UINT32.size * type_count
+        self._code_index_count = code_index_count
+        self._blob = self._code_index + UINT32.size * code_index_count
+        if len(self._map) < self._blob:
+            raise ValueError(f"{path} is truncated")
+        self._decoded = {}
+        self._strings_decoded = {}
+        self._found = {}  # ('type', key) -> device number, ('code', key) -> (device number, entry position)
+        self._all = None
+        self._download_codes = {}
+        self._download_types = None
+        self._emergency_types = None
+
+    def _string_bytes(self, number):
+        start, end = struct.unpack_from('<II', self._map, self._strings + UINT32.size * number)
+        return self._map[self._blob + start:self._blob + end]
+
+    def _string(self, number):
+        if number == NO_STRING:
+            return None
+        string = self._strings_decoded.get(number)
+        if string is None:
+            # Titles, firmware and OS versions repeat across entries, so decode each string once
+            string = self._strings_decoded.setdefault(number, self._string_bytes(number).decode())
+        return string
+
+    def _find(self, index, count, record, size, key):
+        """Binary search a sorted index for `key`, returning the record number or None."""
+        key = key.encode()
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            number = UINT32.unpack_from(self._map, index + UINT32.size * middle)[0]
+            found = self._string_bytes(record.unpack_from(self._map, size + record.size * number)[0])
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return number
+        return None
+
+    def _device(self, number):
+        device = self._decoded.get(number)
+        if device is not None:
+            return device
+
+        product_type, model_name, emergency_id, first_code, code_count, _ = DEVICE.unpack_from(
+            self._map, self._devices + DEVICE.size * number)
+        entries = []
+        for code_number in range(first_code, first_code + code_count):
+            product_code, title, firmware, os_version, _, first_id, id_count = CODE.unpack_from(
+                self._map, self._codes + CODE.size * code_number)
+            entries.append({
+                'ProductCode': self._string(product_code),
+                'PackageTitle': self._string(title),
+                'Firmware': self._string(firmware),
+                'OS': self._string(os_version),
+                'DownloadID': [INT64.unpack_from(self._map, self._download_ids + INT64.size * position)[0]
+                               for position in range(first_id, first_id + id_count)],
+            })
+        device = {
+            'ProductType': self._string(product_type),
+            'ModelName': self._string(model_name),
+            'Emergency': {'DownloadID': None if emergency_id == NO_DOWNLOAD else emergency_id},
+            'ProductCodes': entries,
+        }
+        return self._decoded.setdefault(number, device)
+
+    def device(self, product_type):
+        number = self._found.get(('type', product_type))
+        if number is None:
+            number = self._find(self._type_index, self._type_count, DEVICE, self._devices, product_type)
+            if number is None:
+                return None
+            self._found[('type', product_type)] = number
+        return self._device(number)
+
+    def product_code(self, product_code):
+        found = self._found.get(('code', product_code))
+        if found is None:
+            number = self._find(self._code_index, self._code_index_count, CODE, self._codes, product_code)
+            if number is None:
+                return None, None
+            device_number = CODE.unpack_from(self._map, self._codes + CODE.size * number)[4]
+            first_code = DEVICE.unpack_from(self._map, self._devices + DEVICE.size * device_number)[3]
+            found = self._found[('code', product_code)] = (device_number, number - first_code)
+        device = self._device(found[0])
+        return device, device['ProductCodes'][found[1]]
+
+    def devices(self):
+        if self._all is None:
+            self._all = [self._device(number) for number in range(self.device_count)]
+        return self._all
+
+    def _device_records(self):
+        for number in range(self.device_count):
+            yield DEVICE.unpack_from(self._map, self._devices + DEVICE.size * number)
+
+    def download_codes(self, product_type):
+        codes = self._download_codes.get(product_type)
+        if codes is None:
+            number = self._find(self._type_index, self._type_count, DEVICE, self._devices, product_type)
+            codes = []
+            if number is not None:
+                _, _, _, first_code, code_count, _ = DEVICE.unpack_from(self._map, self._devices + DEVICE.size * number)
+                for code_number in range(first_code, first_code + code_count):
+                    record = CODE.unpack_from(self._map, self._codes + CODE.size * code_number)
+                    if record[6]:
+                        codes.append(self._string(record[0]))
+            codes = self._download_codes.setdefault(product_type, codes)
+        return codes
+
+    def download_types(self):
+        if self._download_types is None:
+            self._download_types = [self._string(record[0]) for record in self._device_records() if record[5]]
+        return self._download_types
+
+    def emergency_types(self):
+        if self._emergency_types is None:
+            self._emergency_types = [self._string(record[0]) for record in self._device_records()
+                                     if record[2] != NO_DOWNLOAD]
+        return self._emergency_types
+
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else 'devices.json'
+    target = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(source)[0] + '.bin'
+
+    stat = os.stat(source)
+    with open(source, 'rb') as json_file:
+        source_data = json_file.read()
+    devices = json.loads(source_data)
+    data = compile_catalog(devices, (stat.st_mtime_ns, stat.st_size), hashlib.sha256(source_data).digest())
+
+    # Replace the file atomically so running bots keep reading their mapped copy of the old one
+    temp_path = f'{target}.tmp'
+    with open(temp_path, 'wb') as catalog_file:
+        catalog_file.write(data)
+        catalog_file.flush()
+        os.fsync(catalog_file.fileno())
+    os.replace(temp_path, target)
+
+    print(f"Compiled {len(devices)} devices from {source} into {target} ({len(data)} bytes)")
+
+
+if __name__ == '__main__':
+    main()
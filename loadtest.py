@@ -0,0 +1,476 @@
+import os
+import sys
+import json
+import math
+import time
+import queue
+import random
+import secrets
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import Request, urlopen
+from urllib.error import URLError, HTTPError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+TOKEN = '123456:loadtest'
+WEBHOOK_PATH = '/webhook'
+CHANNELS = {'FIRMWARE_CHANNEL': -1001, 'EMERGENCY_CHANNEL': -1002, 'UPLOAD_CHANNEL': -1003,
+            'REQUEST_CHANNEL': -1004, 'UNBLOCK_CHANNEL': -1005}
+FIRST_USER_ID = 10_000_000
+
+# Methods whose result is a message sent to a chat, and so may be the reply to a simulated user
+MESSAGE_METHODS = {'sendMessage', 'copyMessage', 'forwardMessage', 'sendDocument'}
+# Methods that never get a 429, so polling and startup are not disturbed
+UNLIMITED_METHODS = {'getUpdates', 'getMe', 'setWebhook', 'deleteWebhook'}
+
+
+class FakeBotApi:
+    """Local stand-in for the Bot API, answering every method the bot uses without touching Telegram.
+
+    Each call is answered after `latency` seconds, give or take `jitter`, and with a probability of
+    `flood_rate` with a 429 asking to retry after `retry_after` seconds. Updates given to `enqueue`
+    are served by getUpdates with long polling, and `on_message(method, chat_id, reply_to)` is
+    called for every message the bot sends.
+    """
+
+    def __init__(self, latency, jitter, flood_rate, retry_after, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.on_message = None
+        self.calls = {}
+        self.flood_injected = 0
+        self.polled = threading.Event()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._updates = []
+        self._has_updates = threading.Condition(self._lock)
+        self._message_id = 0
+        self._server = None
+
+    def start(self):
+        handler = type('Handler', (FakeBotApiHandler,), {'api': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self._server.server_port}/bot{{0}}/{{1}}'
+
+    def stop(self):
+        self._server.shutdown()
+
+    def enqueue(self, update):
+        with self._lock:
+            self._updates.append(update)
+            self._has_updates.notify_all()
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + min(float(params.get('timeout') or 0), 5)
+        self.polled.set()
+        with self._lock:
+            # Updates below the offset have been confirmed by the bot
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._has_updates.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    def _next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def call(self, method, params):
+        """Return (HTTP status, response body) for one Bot API call."""
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+
+        delay = max(self.latency + self._random.uniform(-self.jitter, self.jitter), 0)
+        if delay:
+            time.sleep(delay)
+
+        if method not in UNLIMITED_METHODS and self._random.random() < self.flood_rate:
+            with self._lock:
+                self.flood_injected += 1
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f"Too Many Requests: retry after {self.retry_after}",
+                         'parameters': {'retry_after': self.retry_after}}
+
+        chat_id = params.get('chat_id')
+        chat = {'id': int(chat_id) if chat_id else 0, 'type': 'private', 'first_name': "User"}
+        if method == 'getMe':
+            result = {'id': int(TOKEN.split(':')[0]), 'is_bot': True, 'first_name': "Load Test",
+                      'username': 'loadtest_bot'}
+        elif method == 'getChat':
+            result = chat
+        elif method in ('copyMessages', 'forwardMessages'):
+            result = [{'message_id': self._next_message_id()} for _ in json.loads(params.get('message_ids', '[]'))]
+        elif method in MESSAGE_METHODS:
+            result = {'message_id': self._next_message_id(), 'date': int(time.time()), 'chat': chat,
+                      'text': params.get('text', "")}
+            if method == 'copyMessage':
+                result = {'message_id': result['message_id']}
+        else:
+            result = True
+
+        if method in MESSAGE_METHODS and self.on_message is not None:
+            reply_to = params.get('reply_to_message_id')
+            if reply_to is None and params.get('reply_parameters'):
+                reply_to = json.loads(params['reply_parameters']).get('message_id')
+            self.on_message(method, chat['id'], int(reply_to) if reply_to is not None else None)
+
+        return 200, {'ok': True, 'result': result}
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    api = None
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        method = url.path.rsplit('/', 1)[-1]
+
+        # telebot sends the parameters in the query string, AsyncTeleBot as a form or JSON body
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json') and body:
+            params.update({key: value if isinstance(value, str) else json.dumps(value)
+                           for key, value in json.loads(body).items()})
+        elif content_type.startswith('application/x-www-form-urlencoded'):
+            params.update({key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()})
+
+        status, response = self.api.call(method, params)
+        data = json.dumps(response).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The bot was stopped while waiting on a long poll
+
+    def log_message(self, format, *args):
+        pass
+
+
+def user_scripts(count, seed=0):
+    """Return one list of (step name, message fields) per simulated user, walking through every flow."""
+    with open(f'{current_dir}/devices.json', 'r') as json_file:
+        devices = json.load(json_file)
+
+    rng = random.Random(seed)
+    downloads = [(device['ProductType'], entry['ProductCode']) for device in devices
+                 for entry in device['ProductCodes'] if entry['DownloadID']]
+    missing = [(device['ProductType'], entry['ProductCode']) for device in devices
+               for entry in device['ProductCodes'] if not entry['DownloadID']]
+
+    scripts = []
+    for number in range(count):
+        product_type, product_code = rng.choice(downloads)
+        script = [
+            ('start', {'text': '/start'}),
+            ('download', {'text': '/download'}),
+            ('product_type', {'text': product_type}),
+            ('product_code', {'text': product_code}),
+        ]
+        if missing:
+            script.append(('request', {'text': "/request {} {}".format(*rng.choice(missing))}))
+        script += [
+            ('upload', {'text': '/upload'}),
+            ('upload_file', {'caption': f"{product_type} {product_code}", 'document': {
+                'file_id': f'loadtest-{number}', 'file_unique_id': f'loadtest-{number}',
+                'file_name': f'{product_type}_{product_code}.zip', 'mime_type': 'application/zip',
+                'file_size': 1024 ** 3}}),
+        ]
+        scripts.append(script)
+    return scripts
+
+
+class TrafficGenerator:
+    """Replays the user scripts through the bot, `concurrency` users at a time.
+
+    Every simulated user waits for the bot's reply to one step before sending the next, so the
+    latency of a step is the time from handing its update to the bot to the first message the
+    bot sends to that user in reply to it. Steps without a reply after `timeout` seconds are
+    counted as timed out and skipped.
+    """
+
+    def __init__(self, scripts, concurrency, timeout, deliver):
+        self.scripts = scripts
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.latencies = {}  # step name -> [seconds]
+        self.timeouts = {}  # step name -> count
+        self.updates = 0
+        self._deliver = deliver
+        self._lock = threading.Lock()
+        self._waiting = {}  # chat ID -> [script, step position, message ID, sent at]
+        self._next_user = 0
+        self._update_id = 0
+        self._message_id = 0
+        self._done = threading.Event()
+
+    def _send(self, chat_id, script, position):
+        """Hand the script's step to the bot. Call with the lock held."""
+        self._update_id += 1
+        self._message_id += 1
+        self.updates += 1
+        step, fields = script[position]
+        message = dict(fields, message_id=self._message_id, date=int(time.time()),
+                       chat={'id': chat_id, 'type': 'private'},
+                       **{'from': {'id': chat_id, 'is_bot': False, 'first_name': f"User {chat_id}",
+                                   'username': f'user{chat_id}'}})
+        if message.get('text', '').startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(message['text'].split()[0])}]
+
+        self._waiting[chat_id] = [script, position, self._message_id, time.perf_counter()]
+        self._deliver({'update_id': self._update_id, 'message': message})
+
+    def _start_next_user(self):
+        """Start the next user's script, or finish once nobody is left. Call with the lock held."""
+        if self._next_user < len(self.scripts):
+            self._send(FIRST_USER_ID + self._next_user, self.scripts[self._next_user], 0)
+            self._next_user += 1
+        elif not self._waiting:
+            self._done.set()
+
+    def _advance(self, chat_id):
+        """Send the user's next step, or start another user. Call with the lock held."""
+        script, position, _, _ = self._waiting.pop(chat_id)
+        if position + 1 < len(script):
+            self._send(chat_id, script, position + 1)
+        else:
+            self._start_next_user()
+
+    def on_message(self, method, chat_id, reply_to):
+        with self._lock:
+            waiting = self._waiting.get(chat_id)
+            # Later parts of an earlier reply, such as the rest of a firmware package, are not replies
+            if waiting is None or (reply_to != waiting[2] if reply_to is not None else method != 'sendMessage'):
+                return
+            script, position, _, sent = waiting
+            self.latencies.setdefault(script[position][0], []).append(time.perf_counter() - sent)
+            self._advance(chat_id)
+
+    def run(self):
+        with self._lock:
+            for _ in range(min(self.concurrency, len(self.scripts))):
+                self._start_next_user()
+            if not self.scripts:
+                self._done.set()
+
+        while not self._done.wait(0.5):
+            with self._lock:
+                now = time.perf_counter()
+                for chat_id, (script, position, _, sent) in list(self._waiting.items()):
+                    if now - sent > self.timeout:
+                        step = script[position][0]
+                        self.timeouts[step] = self.timeouts.get(step, 0) + 1
+                        self._advance(chat_id)
+
+
+class WebhookSender:
+    """Posts updates to the bot's webhook from a few threads, retrying while it answers 503."""
+
+    def __init__(self, url, secret, threads=4):
+        self.url = url
+        self.headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret}
+        self._queue = queue.Queue()
+        for _ in range(threads):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, update):
+        self._queue.put(update)
+
+    def _run(self):
+        while True:
+            data = json.dumps(self._queue.get()).encode('utf-8')
+            while True:
+                try:
+                    urlopen(Request(self.url, data=data, headers=self.headers), timeout=30)
+                    break
+                except (HTTPError, URLError, OSError):
+                    time.sleep(0.1)  # Queue full or the bot is restarting
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def wait_until(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def webhook_ready(port):
+    try:
+        urlopen(f'http://127.0.0.1:{port}/', timeout=1)
+        return True
+    except (URLError, OSError):
+        return False
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return None
+    return values[max(math.ceil(fraction * len(values)), 1) - 1]
+
+
+def latency_summary(values):
+    values = sorted(values)
+    return {
+        'replies': len(values),
+        'p50_ms': round(percentile(values, 0.50) * 1000, 2) if values else None,
+        'p90_ms': round(percentile(values, 0.90) * 1000, 2) if values else None,
+        'p99_ms': round(percentile(values, 0.99) * 1000, 2) if values else None,
+        'max_ms': round(values[-1] * 1000, 2) if values else None,
+    }
+
+
+def run(args):
+    data_dir = tempfile.mkdtemp(prefix='lumia_loadtest_')
+    shutil.copy2(f'{current_dir}/devices.json', data_dir)
+    if os.path.exists(f'{current_dir}/devices.bin'):
+        shutil.copy2(f'{current_dir}/devices.bin', data_dir)
+
+    api = FakeBotApi(args.latency / 1000, args.jitter / 1000, args.flood_rate, args.retry_after, args.seed)
+    env = dict(os.environ, DATA_DIR=data_dir, API_TOKEN=TOKEN, BOT_MODE=args.mode, BOT_API_URL=api.start(),
+               USER_STORE=args.store, USER_STORE_PATH=f'{data_dir}/users.db', WEBHOOK_PATH=WEBHOOK_PATH,
+               METRICS_PORT='0', PYTHONUNBUFFERED='1')
+    env.update({channel: str(chat_id) for channel, chat_id in CHANNELS.items()})
+    webhook_port = free_port()
+    if args.mode in ('webhook', 'cluster'):
+        env.update(WEBHOOK_PORT=str(webhook_port), WEBHOOK_LISTEN='127.0.0.1', WEBHOOK_URL='',
+                   WEBHOOK_SECRET=secrets.token_urlsafe(32))
+    for setting in args.set:
+        name, _, value = setting.partition('=')
+        env[name] = value
+
+    scripts = user_scripts(args.users, args.seed)
+    log_file = open(args.log or f'{data_dir}/bot.log', 'w')
+    process = subprocess.Popen([sys.executable, f'{current_dir}/lumia_firmware_download_bot.py'], env=env,
+                               stdout=log_file, stderr=subprocess.STDOUT, cwd=data_dir)
+    try:
+        if args.mode in ('webhook', 'cluster'):
+            ready = wait_until(lambda: webhook_ready(webhook_port) or process.poll() is not None, 60)
+            deliver = WebhookSender(f'http://127.0.0.1:{webhook_port}{WEBHOOK_PATH}', env['WEBHOOK_SECRET']).submit
+        else:
+            ready = wait_until(lambda: api.polled.is_set() or process.poll() is not None, 60)
+            deliver = api.enqueue
+        if not ready or process.poll() is not None:
+            raise RuntimeError(f"The bot did not start, see {log_file.name}")
+
+        generator = TrafficGenerator(scripts, args.concurrency, args.timeout, deliver)
+        api.on_message = generator.on_message
+        print(f"Replaying {args.users} users, {args.concurrency} at a time, against BOT_MODE={args.mode}",
+              file=sys.stderr)
+        started = time.perf_counter()
+        generator.run()
+        duration = time.perf_counter() - started
+    finally:
+        process.terminate()
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log_file.close()
+        api.stop()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    every_step = [latency for latencies in generator.latencies.values() for latency in latencies]
+    return {
+        'users': args.users,
+        'updates': generator.updates,
+        'duration_s': round(duration, 3),
+        'updates_per_sec': round(generator.updates / duration, 1),
+        'latency': latency_summary(every_step),
+        'steps': {step: dict(latency_summary(generator.latencies.get(step, [])),
+                             timeouts=generator.timeouts.get(step, 0))
+                  for step, _ in (scripts[0] if scripts else [])},
+        'timeouts': sum(generator.timeouts.values()),
+        'api_calls': dict(sorted(api.calls.items())),
+        'flood_injected': api.flood_injected,
+    }
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=current_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(results):
+    print(f"{results['updates']} updates in {results['duration_s']:.1f} s, {results['updates_per_sec']:.1f} updates/s, "
+          f"{results['timeouts']} timed out, {results['flood_injected']} 429s injected", file=sys.stderr)
+    print(f"{'step':<16} {'replies':>8} {'p50 ms':>10} {'p99 ms':>10} {'max ms':>10} {'timeouts':>9}", file=sys.stderr)
+    for step, summary in list(results['steps'].items()) + [('all', dict(results['latency'],
+                                                                         timeouts=results['timeouts']))]:
+        print(f"{step:<16} {summary['replies']:>8} {summary['p50_ms'] or 0:>10.2f} {summary['p99_ms'] or 0:>10.2f} "
+              f"{summary['max_ms'] or 0:>10.2f} {summary['timeouts']:>9}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay simulated users through the bot against a local "
+                                                 "stand-in for the Bot API and report reply latencies.")
+    parser.add_argument('--users', type=int, default=1000, help="simulated users")
+    parser.add_argument('--concurrency', type=int, default=100, help="users in flight at the same time")
+    parser.add_argument('--mode', default='sync', choices=('sync', 'async', 'webhook', 'cluster'), help="BOT_MODE")
+    parser.add_argument('--store', default='sqlite', choices=('sqlite', 'json'), help="USER_STORE backend")
+    parser.add_argument('--latency', type=float, default=20, help="Bot API latency in milliseconds")
+    parser.add_argument('--jitter', type=float, default=10, help="random +/- latency in milliseconds")
+    parser.add_argument('--flood-rate', type=float, default=0, help="fraction of Bot API calls answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after of the injected 429s, in seconds")
+    parser.add_argument('--timeout', type=float, default=30, help="seconds to wait for a reply before moving on")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the user scripts and the injected faults")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help="extra environment for the bot, e.g. --set API_RATE_LIMIT=1000")
+    parser.add_argument('--log', help="write the bot's output to this file")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = run(args)
+    print_summary(results)
+
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'settings': {name: value for name, value in vars(args).items() if name not in ('log', 'output')},
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump(report, json_file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
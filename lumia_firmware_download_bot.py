@@ -1,46 +1,2387 @@
 import os
+import re
+import sys
+import signal
+import copy
+import hmac
+import html
 import json
+import queue
+import atexit
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import heapq
+import inspect
+import collections
+import bisect
+import functools
+import requests
 import telebot
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from dotenv import load_dotenv
-from telebot.types import ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv, find_dotenv
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException, ApiHTTPException
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
+from telebot.types import ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, InlineKeyboardMarkup, \
+    InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent, CallbackQuery, InlineQuery
+from catalog_compiler import CompiledCatalog, file_digest
 
-# Get the current directory of the script
-current_dir = os.path.dirname(os.path.abspath(__file__))
+ENV_PATH = find_dotenv()
+load_dotenv(ENV_PATH)
+
+# Get the current directory of the script, which holds devices.json and the data files unless DATA_DIR is set
+current_dir = os.getenv("DATA_DIR") or os.path.dirname(os.path.abspath(__file__))
 
 # Replace with your bot token
-load_dotenv()
 API_TOKEN = os.getenv("API_TOKEN")
 FIRMWARE_CHANNEL = int(os.getenv("FIRMWARE_CHANNEL"))
 EMERGENCY_CHANNEL = int(os.getenv("EMERGENCY_CHANNEL"))
 UPLOAD_CHANNEL = int(os.getenv("UPLOAD_CHANNEL"))
 REQUEST_CHANNEL = int(os.getenv("REQUEST_CHANNEL"))
 UNBLOCK_CHANNEL = int(os.getenv("UNBLOCK_CHANNEL"))
+USER_STORE = os.getenv("USER_STORE", "sqlite").lower()
+USER_STORE_PATH = os.getenv("USER_STORE_PATH", f'{current_dir}/users.db')
+API_RATE_LIMIT = float(os.getenv("API_RATE_LIMIT", 30))
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", 3))
+INBOUND_RATE = float(os.getenv("INBOUND_RATE", 1))  # Updates per second per user, 0 to disable
+INBOUND_BURST = int(os.getenv("INBOUND_BURST", 10))
+INBOUND_MUTE_THRESHOLD = int(os.getenv("INBOUND_MUTE_THRESHOLD", 20))
+INBOUND_MUTE_DURATION = float(os.getenv("INBOUND_MUTE_DURATION", 300))
+INBOUND_INLINE_RATE = float(os.getenv("INBOUND_INLINE_RATE", 3))  # Inline queries per second per user
+INBOUND_INLINE_BURST = int(os.getenv("INBOUND_INLINE_BURST", 30))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 8))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 3))
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", 4))
+DELIVERY_CHAT_RATE = float(os.getenv("DELIVERY_CHAT_RATE", 1))
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", 4 * 1024 ** 3))
+UPLOAD_REVIEW_RATE = float(os.getenv("UPLOAD_REVIEW_RATE", 20 / 60))
+UPLOAD_REVIEW_BATCH_DELAY = float(os.getenv("UPLOAD_REVIEW_BATCH_DELAY", 5))
+REQUEST_DIGEST_INTERVAL = float(os.getenv("REQUEST_DIGEST_INTERVAL", 3600))
+REQUEST_CHECK_INTERVAL = float(os.getenv("REQUEST_CHECK_INTERVAL", 60))
+BOT_MODE = os.getenv("BOT_MODE", "sync").lower()
+ASYNC_WORKERS = int(os.getenv("ASYNC_WORKERS", 32))
+KEYBOARD_PAGE_SIZE = int(os.getenv("KEYBOARD_PAGE_SIZE", 20))
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", 25))
+CATALOG_COMPILED = os.getenv("CATALOG_COMPILED", "devices.bin")
+JSON_FLUSH_INTERVAL = float(os.getenv("JSON_FLUSH_INTERVAL", 1))
+JSON_FLUSH_THRESHOLD = int(os.getenv("JSON_FLUSH_THRESHOLD", 100))
+STATE_TTL = float(os.getenv("STATE_TTL", 3600))
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", 300))
+CHAT_CACHE_NEGATIVE_TTL = float(os.getenv("CHAT_CACHE_NEGATIVE_TTL", 60))
+CHAT_CACHE_MAX_SIZE = int(os.getenv("CHAT_CACHE_MAX_SIZE", 10000))
+STATE_MAX_SIZE = int(os.getenv("STATE_MAX_SIZE", 100000))
+STATE_SNAPSHOT = os.getenv("STATE_SNAPSHOT", "states.json")
+STATE_SNAPSHOT_INTERVAL = float(os.getenv("STATE_SNAPSHOT_INTERVAL", 30))
+QUOTA_LIMITS = json.loads(os.getenv("QUOTA_LIMITS", '{"user": {"download": 2}}'))
+QUOTA_WINDOW = int(os.getenv("QUOTA_WINDOW", 86400))
+QUOTA_FLUSH_INTERVAL = float(os.getenv("QUOTA_FLUSH_INTERVAL", 60))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", 60))
+ANALYTICS_HOURLY_RETENTION = int(os.getenv("ANALYTICS_HOURLY_RETENTION", 7 * 24))  # Hours
+ANALYTICS_DAILY_RETENTION = int(os.getenv("ANALYTICS_DAILY_RETENTION", 365))  # Days
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+UPDATE_LOG = os.getenv("UPDATE_LOG")
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", 4))
+CLUSTER_REPLAY = os.getenv("CLUSTER_REPLAY")
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 1))
+BOT_API_URL = os.getenv("BOT_API_URL")
+
+# The cluster front process and its workers keep conversation states in the shared SQLite user store
+SHARED_STATE = BOT_MODE in ('cluster', 'worker')
+# Request digests and notifications must only be sent by one process
+BACKGROUND_JOBS = BOT_MODE != 'cluster' and WORKER_INDEX == 0
+
+if BOT_API_URL:
+    # e.g. http://127.0.0.1:8081/bot{0}/{1} for a local Bot API server
+    apihelper.API_URL = BOT_API_URL
+
+# Class middlewares let the inbound flood control drop updates before any handler runs
+bot = telebot.TeleBot(API_TOKEN, use_class_middlewares=True)
+
+
+class Metrics:
+    """Thread-safe counters and latency histograms, rendered in the Prometheus text format."""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, labels) -> [count per bucket..., count over the last bucket, sum]
+        self._counters = {}  # (name, labels) -> value
+        self.started = time.time()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            histogram[bisect.bisect_left(self.BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def timed(self, name, **labels):
+        """Decorator recording the wrapped function's duration, and its exceptions under `<name>_errors`."""
+        def decorator(function):
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def coroutine_wrapper(*args, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return await function(*args, **kwargs)
+                    except Exception as e:
+                        self.increment(f'{name}_errors', **labels, **self.error_labels(e))
+                        raise
+                    finally:
+                        self.observe(name, time.perf_counter() - started, **labels)
+                return coroutine_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                except Exception as e:
+                    self.increment(f'{name}_errors', **labels, **self.error_labels(e))
+                    raise
+                finally:
+                    self.observe(name, time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def error_labels(exception):
+        # AsyncTeleBot raises its own ApiTelegramException class, with the same error_code
+        if isinstance(exception, ApiTelegramException) or type(exception).__name__ == 'ApiTelegramException':
+            return {'error': str(exception.error_code)}
+        return {'error': type(exception).__name__}
+
+    def histograms(self, name):
+        """Return [(labels, count, total seconds, approximate p95 seconds)] for one histogram."""
+        with self._lock:
+            items = [(dict(labels), list(histogram)) for (metric, labels), histogram in self._histograms.items()
+                     if metric == name]
+
+        result = []
+        for labels, histogram in items:
+            count = sum(histogram[:-1])
+            cumulative, p95 = 0, None
+            for bound, bucket in zip(self.BUCKETS, histogram):
+                cumulative += bucket
+                if cumulative >= count * 0.95:
+                    p95 = bound
+                    break
+            result.append((labels, count, histogram[-1], p95))
+        return result
+
+    def counters(self, name):
+        with self._lock:
+            return [(dict(labels), value) for (metric, labels), value in self._counters.items() if metric == name]
+
+    def render_prometheus(self):
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}' if labels else ''
+
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        lines = []
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f"# TYPE lumia_{name}_total counter")
+            for (metric, labels), value in counters:
+                if metric == name:
+                    lines.append(f"lumia_{name}_total{format_labels(labels)} {value}")
+
+        for name in sorted({name for (name, _), _ in histograms}):
+            lines.append(f"# TYPE lumia_{name}_seconds histogram")
+            for (metric, labels), histogram in histograms:
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(self.BUCKETS + ('+Inf',), histogram):
+                    cumulative += bucket
+                    lines.append(f"lumia_{name}_seconds_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"lumia_{name}_seconds_sum{format_labels(labels)} {histogram[-1]}")
+                lines.append(f"lumia_{name}_seconds_count{format_labels(labels)} {cumulative}")
+
+        lines.append("# TYPE lumia_uptime_seconds gauge")
+        lines.append(f"lumia_uptime_seconds {time.time() - self.started}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+# Bot API methods the bot calls, timed per method; reply_to goes through send_message
+INSTRUMENTED_API_METHODS = ('send_message', 'copy_message', 'copy_messages', 'forward_message', 'forward_messages',
+                            'get_chat',
+                            'delete_message', 'edit_message_text', 'edit_message_reply_markup', 'send_document',
+                            'answer_callback_query', 'answer_inline_query')
+
+
+def instrument_api_methods(target=bot):
+    for method in INSTRUMENTED_API_METHODS:
+        timed = metrics.timed('api_call', method=method)(getattr(target, method))
+        setattr(target, method, count_flood_errors(method, timed))
+
+
+def count_flood_errors(method, function):
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def coroutine_wrapper(*args, **kwargs):
+            try:
+                return await function(*args, **kwargs)
+            except Exception as e:
+                if getattr(e, 'error_code', None) == 429:
+                    metrics.increment('api_flood_limited', method=method)
+                raise
+        return coroutine_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                metrics.increment('api_flood_limited', method=method)
+            raise
+    return wrapper
 
-user_states = {}
-bot = telebot.TeleBot(API_TOKEN)
 
-print("bot started running")
+instrument_api_methods()
 
 
 def super_admins():
-    load_dotenv(override=True)
-    return [int(admin_id.strip()) for admin_id in os.getenv("SUPER_ADMIN", "").split(',') if admin_id.strip()]
+    return acl.super_admins()
 
 
 def load_json(file_name):
+    pending = json_writer.pending(file_name)
+    if pending is not None:
+        return pending
+
     try:
+        started = time.perf_counter()
         with open(f'{current_dir}/{file_name}', 'r') as json_file:
-            return json.load(json_file)
-    except:
-        with open(f'{current_dir}/{file_name}', 'w') as json_file:
-            json.dump([], json_file, indent=4)
-            return []
+            data = json.load(json_file)
+        metrics.observe('file_read', time.perf_counter() - started, file=file_name)
+        return data
+    except FileNotFoundError:
+        write_json_atomic(file_name, [])
+        return []
+    except ValueError:
+        # Keep the unreadable file around instead of silently overwriting it
+        corrupt_path = f'{current_dir}/{file_name}.corrupt-{int(time.time())}'
+        os.replace(f'{current_dir}/{file_name}', corrupt_path)
+        print(f"{file_name} could not be parsed and was moved to {corrupt_path}")
+        write_json_atomic(file_name, [])
+        return []
 
 
 def dump_json(file_name, data):
-    with open(f'{current_dir}/{file_name}', 'w') as json_file:
-        return json.dump(data, json_file, indent=4)
+    json_writer.write(file_name, data)
+
+
+def write_json_atomic(file_name, data, indent=None):
+    """Write JSON to a temporary file, fsync it and rename it over the target, so readers never see half a file."""
+    started = time.perf_counter()
+    file_path = f'{current_dir}/{file_name}'
+    # A temporary file of its own, since /export_users and the writer thread may write the same file at once
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=f'{os.path.basename(file_path)}.',
+                                             suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'w') as json_file:
+            json.dump(data, json_file, indent=indent, separators=(', ', ': ') if indent else (',', ':'))
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        try:
+            mode = os.stat(file_path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(temp_path, mode)  # mkstemp creates it readable by the owner only
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    if hasattr(os, 'O_DIRECTORY'):
+        directory = os.open(os.path.dirname(file_path), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    metrics.observe('file_write', time.perf_counter() - started, file=file_name)
+
+
+def file_signature(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class JsonWriter:
+    """Write-behind persistence for dump_json.
+
+    Writes are coalesced in memory, keeping only the latest data per file, and flushed with
+    `write_json_atomic` every `interval` seconds, as soon as `threshold` writes are pending,
+    and on exit.
+    """
+
+    def __init__(self, interval, threshold):
+        self.interval = interval
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._signatures = {}
+        self._writes = 0
+        self._wake = threading.Event()
+
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+        atexit.register(self.flush)
+
+    def write(self, file_name, data):
+        with self._lock:
+            self._pending[file_name] = data
+            self._writes += 1
+            if self._writes >= self.threshold:
+                self._wake.set()
+
+    def pending(self, file_name):
+        """Return the data still waiting to be written to the file, or None."""
+        with self._lock:
+            return self._pending.get(file_name)
+
+    def signature(self, file_name):
+        """Return the file signature right after our last write to it."""
+        return self._signatures.get(file_name)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._writes = 0
+
+            for file_name, data in pending.items():
+                try:
+                    write_json_atomic(file_name, data)
+                    self._signatures[file_name] = file_signature(f'{current_dir}/{file_name}')
+                except (OSError, TypeError, ValueError) as e:
+                    print(f"Failed to write {file_name}: {e}")
+                    with self._lock:
+                        self._pending.setdefault(file_name, data)
+
+    def _flush_periodically(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+
+json_writer = JsonWriter(JSON_FLUSH_INTERVAL, JSON_FLUSH_THRESHOLD)
+
+
+class ConversationStates:
+    """Thread-safe map of user ID to the step of the flow the user is in.
+
+    Entries expire `ttl` seconds after they are set, and past `max_size` entries the least
+    recently used ones are evicted. When `snapshot_file` is given the states are saved to it
+    every `snapshot_interval` seconds and on exit, and loaded back on start.
+
+    With a `store` instead, every change is written through to its states table and the states
+    are loaded from it on start. Cluster workers share the store; since each user's updates go
+    to a single worker, that worker's memory stays authoritative for its users. Rows are deleted
+    whenever their entry leaves memory, and expired rows are purged on start and every
+    `snapshot_interval` seconds.
+    """
+
+    def __init__(self, ttl, max_size, snapshot_file=None, snapshot_interval=30, store=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.snapshot_file = snapshot_file
+        self.store = store
+        self._lock = threading.Lock()
+        self._states = collections.OrderedDict()  # user ID -> (state, expires at), least recently used first
+        self._dirty = False
+
+        if store is not None:
+            now = time.time()
+            store.delete_expired_states(now)
+            for record in store.all('states'):
+                if record['Expires'] > now:
+                    self._states[record['UserID']] = (record['State'], record['Expires'])
+            threading.Thread(target=self._purge_periodically, args=(snapshot_interval,), daemon=True).start()
+        elif snapshot_file:
+            self._load()
+            threading.Thread(target=self._snapshot_periodically, args=(snapshot_interval,), daemon=True).start()
+            atexit.register(self.snapshot)
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._states.get(user_id)
+            if entry is None:
+                return None
+            if entry[1] > time.time():
+                self._states.move_to_end(user_id)
+                return entry[0]
+            del self._states[user_id]
+            self._dirty = True
+
+        if self.store is not None:
+            self.store.delete('states', user_id)
+        return None
+
+    def set(self, user_id, state, ttl=None):
+        expires = time.time() + (ttl or self.ttl)
+        with self._lock:
+            self._states[user_id] = (state, expires)
+            self._states.move_to_end(user_id)
+            self._dirty = True
+            evicted = [self._states.popitem(last=False)[0] for _ in range(len(self._states) - self.max_size)]
+
+        if self.store is not None:
+            self.store.upsert('states', {'UserID': user_id, 'State': state, 'Expires': expires})
+            for evicted_id in evicted:
+                self.store.delete('states', evicted_id)
+
+    def pop(self, user_id):
+        """Clear the user's state, returning it (or None if the user was not in a flow)."""
+        with self._lock:
+            entry = self._states.pop(user_id, None)
+            self._dirty = self._dirty or entry is not None
+
+        # The row may outlive the entry, for instance when another worker handled the user before
+        if self.store is not None:
+            self.store.delete('states', user_id)
+        return entry[0] if entry is not None and entry[1] > time.time() else None
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [user_id for user_id, (_, expires) in self._states.items() if expires <= now]
+            for user_id in expired:
+                del self._states[user_id]
+            self._dirty = self._dirty or bool(expired)
+
+        if self.store is not None:
+            self.store.delete_expired_states(now)
+
+    def __len__(self):
+        return len(self._states)
+
+    def _load(self):
+        try:
+            with open(f'{current_dir}/{self.snapshot_file}', 'r') as json_file:
+                snapshot = json.load(json_file)
+        except (OSError, ValueError):
+            return
+
+        now = time.time()
+        for user_id, state, expires in snapshot:
+            if expires > now:
+                self._states[int(user_id)] = (state, expires)
+
+    def snapshot(self):
+        self.purge_expired()
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = [[user_id, state, expires] for user_id, (state, expires) in self._states.items()]
+            self._dirty = False
+
+        write_json_atomic(self.snapshot_file, snapshot)
+
+    def _purge_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.purge_expired()
+            except sqlite3.Error as e:
+                print(f"Failed to purge expired conversation states: {e}")
+
+    def _snapshot_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.snapshot()
+            except OSError as e:
+                print(f"Failed to snapshot conversation states: {e}")
+
+
+class ConversationFlows:
+    """Routes the messages of users in the middle of a flow to the handler of their state.
+
+    Each state is declared with the content types its handler accepts and the states it may
+    move the user on to. A single catch-all message handler looks the user's state up once and
+    calls the handler from the table, instead of every state registering its own filter.
+    """
+
+    def __init__(self):
+        self.states = {}  # state -> (handler, content types, next states)
+
+    def state(self, name, content_types=('text',), transitions=()):
+        """Decorator declaring the handler for a state."""
+        def decorator(function):
+            self.states[name] = (function, frozenset(content_types), frozenset(transitions))
+            return function
+        return decorator
+
+    def content_types(self):
+        return sorted(set().union(*(content_types for _, content_types, _ in self.states.values())))
+
+    def start(self, user_id, state):
+        """Put the user at the start of a flow."""
+        if state not in self.states:
+            raise ValueError(f"Unknown conversation state: {state}")
+        user_states.set(user_id, state)
+
+    def advance(self, user_id, state):
+        """Move the user on to the next state of their flow, which their current state must declare."""
+        current = user_states.get(user_id)
+        if current not in self.states or state not in self.states[current][2]:
+            raise ValueError(f"Conversation state {current} does not lead to {state}")
+        user_states.set(user_id, state)
+
+    def accepting_state(self, message):
+        """Return the sender's state, or None if they have none or its handler does not take the message."""
+        state = user_states.get(message.from_user.id)
+        entry = self.states.get(state)
+        if entry is None or message.content_type not in entry[1]:
+            return None
+        return state
+
+    def dispatch(self, message):
+        """Hand the message to its sender's state handler, returning False if their state does not take it."""
+        state = self.accepting_state(message)
+        if state is None:
+            return False
+        self.states[state][0](message)
+        return True
+
+
+class JsonCatalog:
+    """devices.json parsed into dicts, indexed by product type and product code."""
+
+    def __init__(self, devices):
+        product_types = {}
+        product_codes = {}
+        download_codes = {}
+
+        for device in devices:
+            product_types.setdefault(device['ProductType'], device)
+            codes = download_codes.setdefault(device['ProductType'], [])
+            for entry in device['ProductCodes']:
+                product_codes.setdefault(entry['ProductCode'], (device, entry))
+                if entry['DownloadID']:
+                    codes.append(entry['ProductCode'])
+
+        self._devices = devices
+        self._product_types = product_types
+        self._product_codes = product_codes
+        self._download_codes = download_codes
+        self._download_types = [device['ProductType'] for device in devices
+                                if download_codes[device['ProductType']]]
+        self._emergency_types = [device['ProductType'] for device in devices if device['Emergency']['DownloadID']]
+
+    def devices(self):
+        return self._devices
+
+    def device(self, product_type):
+        return self._product_types.get(product_type)
+
+    def product_code(self, product_code):
+        return self._product_codes.get(product_code, (None, None))
+
+    def download_codes(self, product_type):
+        return self._download_codes.get(product_type, [])
+
+    def download_types(self):
+        return self._download_types
+
+    def emergency_types(self):
+        return self._emergency_types
+
+
+class DeviceCatalog:
+    """View of devices.json, indexed by product type and product code.
+
+    If a catalog compiled from the current devices.json by catalog_compiler.py is present, it is
+    memory-mapped instead of parsing the JSON. When devices.json no longer has the recorded source
+    mtime and size, as after a deploy or checkout, its SHA-256 is compared with the recorded one
+    instead, and a compiled catalog of other contents is ignored, so a forgotten rebuild only costs
+    load time.
+    The files are only loaded again when their mtime or size changes, and the change check itself
+    is throttled to once every `check_interval` seconds.
+    """
+
+    def __init__(self, file_name, check_interval=1.0, compiled_name=None):
+        self.file_path = f'{current_dir}/{file_name}'
+        self.compiled_path = f'{current_dir}/{compiled_name}' if compiled_name else None
+        self.check_interval = check_interval
+        self.version = 0
+        self._lock = threading.Lock()
+        self._signature = None
+        self._next_check = 0.0
+        self._data = JsonCatalog([])
+
+    def _refresh(self):
+        now = time.monotonic()
+        # Until the first load finishes, wait on the lock rather than answer from the empty catalog
+        if now < self._next_check and self.version:
+            return
+
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+
+            signature = (file_signature(self.file_path),
+                         file_signature(self.compiled_path) if self.compiled_path else None)
+            if signature == self._signature:
+                return
+
+            data = self._load(*signature)
+            if data is None:
+                # Keep serving the last good catalog while the file is missing or being rewritten
+                return
+
+            # Swap the catalog in one go so readers never see a half-built one
+            self._data = data
+            self._signature = signature
+            self.version += 1
+
+    def _load(self, source_signature, compiled_signature):
+        if compiled_signature is not None:
+            try:
+                started = time.perf_counter()
+                data = CompiledCatalog(self.compiled_path)
+                if (source_signature is None or data.source_signature == source_signature
+                        or data.source_digest == file_digest(self.file_path)):
+                    metrics.observe('file_read', time.perf_counter() - started,
+                                    file=os.path.basename(self.compiled_path))
+                    return data
+                print(f"Ignoring {self.compiled_path} as it was not compiled from the current {self.file_path}")
+            except (OSError, ValueError) as e:
+                print(f"Failed to load the compiled catalog {self.compiled_path}: {e}")
+
+        if source_signature is None:
+            return None
+        try:
+            started = time.perf_counter()
+            with open(self.file_path, 'r') as json_file:
+                devices = json.load(json_file)
+            metrics.observe('file_read', time.perf_counter() - started, file=os.path.basename(self.file_path))
+        except (OSError, ValueError):
+            return None
+        return JsonCatalog(devices)
+
+    def devices(self):
+        self._refresh()
+        return self._data.devices()
+
+    def device(self, product_type):
+        self._refresh()
+        return self._data.device(product_type)
+
+    def product_code(self, product_code):
+        self._refresh()
+        return self._data.product_code(product_code)
+
+    def current_version(self):
+        self._refresh()
+        return self.version
+
+    def download_codes(self, product_type):
+        self._refresh()
+        return self._data.download_codes(product_type)
+
+    def download_types(self):
+        self._refresh()
+        return self._data.download_types()
+
+    def emergency_types(self):
+        self._refresh()
+        return self._data.emergency_types()
+
+
+catalog = DeviceCatalog('devices.json', compiled_name=CATALOG_COMPILED or None)
+
+# Selection lists offered as keyboards, with the state a selection is handled in
+KEYBOARD_KINDS = {
+    'types': 'awaiting_product_type',
+    'codes': 'awaiting_product_code',
+    'emergency': 'awaiting_emergency_files',
+}
+
+
+def keyboard_options(kind, product_type=None):
+    if kind == 'types':
+        return catalog.download_types()
+    elif kind == 'codes':
+        return catalog.download_codes(product_type)
+    return catalog.emergency_types()
+
+
+class KeyboardCache:
+    """Serialized selection keyboards, built once per catalog version.
+
+    Lists of up to KEYBOARD_PAGE_SIZE options are sent as reply keyboards. Longer lists become
+    paginated inline keyboards whose callback data carries the catalog version, so buttons
+    from before a devices.json change can be recognised as stale.
+    """
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._version = None
+        self._markups = {}
+
+    def get(self, kind, product_type=None, page=0):
+        version = catalog.current_version()
+        key = (kind, product_type, page)
+
+        with self._lock:
+            if version != self._version:
+                self._markups = {}
+                self._version = version
+            markup = self._markups.get(key)
+
+        if markup is None:
+            markup = self._build(kind, product_type, page, version)
+            with self._lock:
+                if version == self._version:
+                    self._markups[key] = markup
+        return markup
+
+    def pages(self, kind, product_type=None):
+        return max(1, -(-len(keyboard_options(kind, product_type)) // self.page_size))
+
+    def _build(self, kind, product_type, page, version):
+        options = keyboard_options(kind, product_type)
+
+        if len(options) <= self.page_size:
+            markup = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True, row_width=2)
+            markup.add(*[KeyboardButton(option) for option in options])
+            return markup.to_json()
+
+        pages = self.pages(kind, product_type)
+        page = min(max(page, 0), pages - 1)
+        suffix = f":{product_type}" if product_type else ""
+
+        markup = InlineKeyboardMarkup(row_width=2)
+        markup.add(*[InlineKeyboardButton(option, callback_data=f"ks:{kind}:{version}:{option}")
+                     for option in options[page * self.page_size:(page + 1) * self.page_size]])
+
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("« Prev", callback_data=f"kb:{kind}:{version}:{page - 1}{suffix}"))
+        navigation.append(InlineKeyboardButton(f"{page + 1}/{pages}",
+                                               callback_data=f"kb:{kind}:{version}:{page}{suffix}"))
+        if page < pages - 1:
+            navigation.append(InlineKeyboardButton("Next »", callback_data=f"kb:{kind}:{version}:{page + 1}{suffix}"))
+        markup.row(*navigation)
+        return markup.to_json()
+
+
+keyboards = KeyboardCache(KEYBOARD_PAGE_SIZE)
+
+
+def search_tokens(text, split=True):
+    """Split text into lowercase search tokens, also indexing hyphenated words joined and in parts.
+
+    rm-1010 is indexed as rm-1010, rm1010, rm and 1010; queries pass split=False and keep it whole.
+    """
+    tokens = []
+    for word in re.findall(r'[a-z0-9]+(?:-[a-z0-9]+)*', (text or '').lower()):
+        tokens.append(word)
+        if split and '-' in word:
+            tokens.append(word.replace('-', ''))
+            tokens.extend(word.split('-'))
+    return tokens
+
+
+def within_edits(a, b, limit):
+    """Return True if a and b are at most `limit` edits apart, counting adjacent swaps as one edit."""
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    a, b = a[start:], b[start:]
+    if not a or not b:
+        return len(a) + len(b) <= limit
+    if limit == 0 or abs(len(a) - len(b)) > limit:
+        return False
+
+    # The first difference is a substitution, a deletion, an insertion or a swap
+    limit -= 1
+    return (within_edits(a[1:], b[1:], limit) or within_edits(a[1:], b, limit) or within_edits(a, b[1:], limit) or
+            (len(a) > 1 and len(b) > 1 and a[0] == b[1] and a[1] == b[0] and within_edits(a[2:], b[2:], limit)))
+
+
+class SearchIndex:
+    """Token index over product types, model names, product codes and package titles.
+
+    Each query word is matched exactly, then by prefix over the sorted token list, and only if
+    neither finds anything, by edit distance against the words it shares a deletion variant with,
+    so typos cost a few dictionary lookups however large the catalog grows. Documents
+    are numbered in the order results are listed, so the posting lists are already ranked and a
+    search stops as soon as it has `limit` results.
+    """
+
+    # Cap on how many index tokens one query word may expand to
+    MAX_EXPANSION = 64
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._documents = []
+        self._postings = {}
+        self._posting_sets = {}
+        self._tokens = []
+        self._variants = {}
+
+    def _ensure_built(self):
+        version = catalog.current_version()
+        if version == self._version:
+            return
+
+        with self._lock:
+            if version == self._version:
+                return
+
+            documents = []
+            words = set()
+            for device in catalog.devices():
+                device_tokens = search_tokens(f"{device['ProductType']} {device['ModelName']}")
+                documents.append(((device, None), device_tokens))
+                words.update(device_tokens)
+                for entry in device['ProductCodes']:
+                    title_tokens = search_tokens(entry['PackageTitle'])
+                    documents.append(((device, entry), device_tokens + search_tokens(entry['ProductCode']) +
+                                      title_tokens))
+                    words.update(title_tokens)
+
+            # Product types first, then codes that can be downloaded, then the rest, each in catalog order
+            documents.sort(key=lambda document: (document[0][1] is not None,
+                                                 not (document[0][1] is None or document[0][1]['DownloadID'])))
+
+            postings = {}
+            for number, (_, tokens) in enumerate(documents):
+                for token in dict.fromkeys(tokens):
+                    postings.setdefault(token, []).append(number)
+
+            # A word and a token within the edit limit are equal once each has lost at most that many
+            # characters. Product codes are left out: they are random strings, thousands of them within
+            # two edits of each other, so a mistyped code would only match a page of unrelated ones.
+            variants = {}
+            for token in words:
+                for variant in self._deletions(token, self._edit_limit(token)):
+                    variants.setdefault(variant, []).append(token)
+
+            self._documents = [result for result, _ in documents]
+            self._postings = postings
+            self._posting_sets = {token: frozenset(numbers) for token, numbers in postings.items()}
+            self._tokens = sorted(postings)
+            self._variants = variants
+            self._version = version
+
+    @staticmethod
+    def _edit_limit(word):
+        return 1 if len(word) <= 5 else 2
+
+    @staticmethod
+    def _deletions(word, limit):
+        """Return the strings left after deleting up to `limit` characters from the word."""
+        variants = frontier = {word}
+        for _ in range(limit):
+            frontier = {variant[:i] + variant[i + 1:] for variant in frontier for i in range(len(variant))}
+            variants = variants | frontier
+        return variants
+
+    def _match(self, word):
+        """Return the index tokens matching one query word: exact, else by prefix, else fuzzy."""
+        if word in self._postings:
+            return [word]
+
+        start = bisect.bisect_left(self._tokens, word)
+        tokens = [token for token in self._tokens[start:start + self.MAX_EXPANSION] if token.startswith(word)]
+        if tokens:
+            return tokens
+
+        limit = self._edit_limit(word)
+        candidates = set()
+        for variant in self._deletions(word, limit):
+            candidates.update(self._variants.get(variant, ()))
+        return [token for token in sorted(candidates) if within_edits(word, token, limit)]
+
+    def _ranked(self, tokens):
+        """Yield the documents of any of the tokens once each, in rank order."""
+        if len(tokens) == 1:
+            yield from self._postings[tokens[0]]
+            return
+        previous = None
+        for document in heapq.merge(*(self._postings[token] for token in tokens)):
+            if document != previous:
+                previous = document
+                yield document
+
+    def search(self, query, limit=10):
+        """Return up to `limit` (device, entry) pairs matching every word of the query.
+
+        `entry` is None when the match is the product type itself rather than one of its product codes.
+        """
+        self._ensure_built()
+
+        words = [self._match(word) for word in dict.fromkeys(search_tokens(query, split=False))]
+        if not words or not all(words):
+            return []
+
+        # Walk the most selective word's documents in rank order, keeping those the other words match too
+        words.sort(key=lambda tokens: sum(len(self._postings[token]) for token in tokens))
+        others = [[self._posting_sets[token] for token in tokens] for tokens in words[1:]]
+        results = []
+        for document in self._ranked(words[0]):
+            if all(any(document in documents for documents in word) for word in others):
+                results.append(self._documents[document])
+                if len(results) == limit:
+                    break
+        return results
+
+
+search_index = SearchIndex()
+
+
+def format_search_result(device, entry):
+    if entry is None:
+        return f"<code>{device['ProductType']}</code> {html.escape(device['ModelName'])}"
+    availability = "available" if entry['DownloadID'] else "not available, use /request"
+    return (f"<code>{device['ProductType']}</code> <code>{entry['ProductCode']}</code> "
+            f"{html.escape(entry['PackageTitle'])} ({availability})")
+
+
+# Tables kept by the user store and the JSON file each one maps to
+USER_TABLES = {
+    'users': 'users.json',
+    'admins': 'admins.json',
+    'blocked': 'blocked.json',
+    'quotas': 'quotas.json',
+    'uploads': 'uploads.json',
+    'requests': 'requests.json',
+    'states': 'conversation_states.json',
+    'downloads': 'downloads.json',
+    'unreachable': 'unreachable.json',
+}
+
+USER_TABLE_COLUMNS = {
+    'users': ('UserID', 'Fullname', 'Username', 'Bot', 'TotalRequests', 'LastRequested'),
+    'admins': ('UserID', 'Fullname', 'Username'),
+    'blocked': ('UserID', 'Fullname', 'Username', 'Reason'),
+    'quotas': ('UserID', 'Windows'),
+    'uploads': ('FileUniqueID', 'UserID', 'FileName', 'FileSize', 'Status', 'Submitted'),
+    'requests': ('ProductCode', 'ProductType', 'Requesters', 'Reported', 'Requested'),
+    'states': ('UserID', 'State', 'Expires'),
+    'downloads': ('Bucket', 'Period', 'Start', 'Kind', 'Name', 'Count'),
+    'unreachable': ('UserID', 'Reason', 'Since', 'Record'),
+}
+
+# Tables keyed by something other than UserID
+USER_TABLE_KEYS = {'uploads': 'FileUniqueID', 'requests': 'ProductCode', 'downloads': 'Bucket'}
+
+# Columns holding nested JSON, stored as text in SQLite
+USER_TABLE_JSON_COLUMNS = {'Windows', 'Requesters', 'Record'}
+
+
+class JsonUserStore:
+    """User store backed by the original users.json, admins.json and blocked.json files.
+
+    Each file is loaded once into a dict keyed by UserID; every mutation rewrites the file.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._tables = {}
+        self._signatures = {}
+
+    def _table(self, table):
+        if table not in self._tables:
+            key = USER_TABLE_KEYS.get(table, 'UserID')
+            self._tables[table] = {record[key]: record for record in load_json(USER_TABLES[table])}
+            self._signatures[table] = file_signature(f'{current_dir}/{USER_TABLES[table]}')
+        return self._tables[table]
+
+    def _save(self, table):
+        dump_json(USER_TABLES[table], [dict(record) for record in self._tables[table].values()])
+
+    def changed(self, table):
+        """Return True if the table's file was edited outside the bot, dropping the stale copy."""
+        file_name = USER_TABLES[table]
+        with self._lock:
+            if table in self._tables:
+                if json_writer.pending(file_name) is not None:
+                    return False
+                signature = file_signature(f'{current_dir}/{file_name}')
+                if signature in (self._signatures[table], json_writer.signature(file_name)):
+                    return False
+            self._tables.pop(table, None)
+            return True
+
+    def get(self, table, key):
+        with self._lock:
+            record = self._table(table).get(key)
+            return dict(record) if record is not None else None
+
+    def all(self, table):
+        with self._lock:
+            return [dict(record) for record in self._table(table).values()]
+
+    def upsert(self, table, record):
+        self.upsert_many(table, [record])
+
+    def upsert_many(self, table, records):
+        with self._lock:
+            key = USER_TABLE_KEYS.get(table, 'UserID')
+            for record in records:
+                self._table(table)[record[key]] = dict(record)
+            self._save(table)
+
+    def delete(self, table, key):
+        with self._lock:
+            if self._table(table).pop(key, None) is None:
+                return False
+            self._save(table)
+            return True
+
+    def delete_expired_states(self, now):
+        """Delete the conversation states that expired by `now`, returning how many were deleted."""
+        with self._lock:
+            states = self._table('states')
+            expired = [user_id for user_id, record in states.items() if record['Expires'] <= now]
+            for user_id in expired:
+                del states[user_id]
+            if expired:
+                self._save('states')
+            return len(expired)
+
+    def page(self, table, after=None, before=None, limit=50, prefix=None):
+        """Return up to `limit` records in UserID order, after `after` or, paging backwards, before `before`.
+
+        With `prefix` only records whose UserID or Username (with or without the @) starts with it are returned.
+        """
+        with self._lock:
+            records = sorted(self._table(table).values(), key=lambda record: record['UserID'])
+
+        if prefix:
+            prefix = prefix.lstrip('@').lower()
+            records = [record for record in records if str(record['UserID']).startswith(prefix) or
+                       (record['Username'] or '').lstrip('@').lower().startswith(prefix)]
+        if after is not None:
+            records = records[bisect.bisect_right([record['UserID'] for record in records], after):]
+        if before is not None:
+            records = records[:bisect.bisect_left([record['UserID'] for record in records], before)]
+            records = records[-limit:] if limit else []
+        return [dict(record) for record in records[:limit]]
+
+    def update(self, table, key, function):
+        """Replace the record with `function(record)` atomically, leaving it alone if that returns None.
+
+        `function` gets a copy of the record, or None if there is none. Returns the record as it was.
+        """
+        with self._lock:
+            record = self._table(table).get(key)
+            previous = copy.deepcopy(record)
+            updated = function(copy.deepcopy(record))
+            if updated is not None:
+                self._table(table)[key] = dict(updated)
+                self._save(table)
+            return previous
+
+    def increment_requests(self, user_id, requested_at):
+        """Count a download for the user, returning False if the user has no record yet."""
+        with self._lock:
+            record = self._table('users').get(user_id)
+            if record is None:
+                return False
+            record['TotalRequests'] += 1
+            record['LastRequested'] = requested_at
+            self._save('users')
+            return True
+
+
+class SqliteUserStore:
+    """User store kept in a single SQLite database in WAL mode, one row per user keyed by UserID.
+
+    The first time the database is opened the existing JSON files are imported into it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._signatures = {}
+
+        connection = self._connection()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS meta (Key TEXT PRIMARY KEY, Value TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS users (UserID INTEGER PRIMARY KEY, Fullname TEXT, "
+                               "Username TEXT, Bot INTEGER, TotalRequests INTEGER, LastRequested TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS admins (UserID INTEGER PRIMARY KEY, Fullname TEXT, "
+                               "Username TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS blocked (UserID INTEGER PRIMARY KEY, Fullname TEXT, "
+                               "Username TEXT, Reason TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS quotas (UserID INTEGER PRIMARY KEY, Windows TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS uploads (FileUniqueID TEXT PRIMARY KEY, UserID INTEGER, "
+                               "FileName TEXT, FileSize INTEGER, Status TEXT, Submitted TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS requests (ProductCode TEXT PRIMARY KEY, ProductType TEXT, "
+                               "Requesters TEXT, Reported INTEGER, Requested TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS states (UserID INTEGER PRIMARY KEY, State TEXT, "
+                               "Expires REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS downloads (Bucket TEXT PRIMARY KEY, Period TEXT, "
+                               "Start INTEGER, Kind TEXT, Name TEXT, Count INTEGER)")
+            connection.execute("CREATE TABLE IF NOT EXISTS unreachable (UserID INTEGER PRIMARY KEY, Reason TEXT, "
+                               "Since TEXT, Record TEXT)")
+
+        if connection.execute("SELECT 1 FROM meta WHERE Key = 'migrated'").fetchone() is None:
+            self.migrate_from_json()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _observe(operation, table, started):
+        metrics.observe('store_query', time.perf_counter() - started, query=f'{operation} {table}')
+
+    @staticmethod
+    def _record(table, row):
+        record = dict(row)
+        if table == 'users':
+            record['Bot'] = bool(record['Bot'])
+        for column in USER_TABLE_JSON_COLUMNS.intersection(record):
+            record[column] = json.loads(record[column]) if record[column] is not None else None
+        return record
+
+    def migrate_from_json(self):
+        connection = self._connection()
+        with connection:
+            for table, file_name in USER_TABLES.items():
+                if not os.path.exists(f'{current_dir}/{file_name}'):
+                    continue
+                for record in load_json(file_name):
+                    self._upsert(connection, table, record)
+            connection.execute("INSERT OR REPLACE INTO meta (Key, Value) VALUES ('migrated', ?)",
+                               (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+
+    @staticmethod
+    def _upsert(connection, table, record):
+        columns = USER_TABLE_COLUMNS[table]
+        connection.execute(f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) "
+                           f"VALUES ({', '.join('?' * len(columns))})",
+                           tuple(json.dumps(record.get(column)) if column in USER_TABLE_JSON_COLUMNS
+                                 else record.get(column) for column in columns))
+
+    def get(self, table, key):
+        started = time.perf_counter()
+        row = self._connection().execute(f"SELECT * FROM {table} WHERE {USER_TABLE_KEYS.get(table, 'UserID')} = ?",
+                                         (key,)).fetchone()
+        self._observe('get', table, started)
+        return self._record(table, row) if row is not None else None
+
+    def all(self, table):
+        started = time.perf_counter()
+        records = [self._record(table, row) for row in self._connection().execute(f"SELECT * FROM {table}")]
+        self._observe('all', table, started)
+        return records
+
+    def upsert(self, table, record):
+        self.upsert_many(table, [record])
+
+    def upsert_many(self, table, records):
+        started = time.perf_counter()
+        connection = self._connection()
+        with connection:
+            for record in records:
+                self._upsert(connection, table, record)
+        self._observe('upsert', table, started)
+
+    def delete(self, table, key):
+        started = time.perf_counter()
+        connection = self._connection()
+        with connection:
+            deleted = connection.execute(f"DELETE FROM {table} WHERE {USER_TABLE_KEYS.get(table, 'UserID')} = ?",
+                                         (key,)).rowcount > 0
+        self._observe('delete', table, started)
+        return deleted
+
+    def delete_expired_states(self, now):
+        """Delete the conversation states that expired by `now`, returning how many were deleted."""
+        started = time.perf_counter()
+        connection = self._connection()
+        with connection:
+            deleted = connection.execute("DELETE FROM states WHERE Expires <= ?", (now,)).rowcount
+        self._observe('delete_expired', 'states', started)
+        return deleted
+
+    def page(self, table, after=None, before=None, limit=50, prefix=None):
+        """Return up to `limit` records in UserID order, after `after` or, paging backwards, before `before`.
+
+        With `prefix` only records whose UserID or Username (with or without the @) starts with it are returned.
+        Pages are read with the UserID primary key, so only the rows of the page are loaded.
+        """
+        conditions = []
+        parameters = []
+        if after is not None:
+            conditions.append("UserID > ?")
+            parameters.append(after)
+        if before is not None:
+            conditions.append("UserID < ?")
+            parameters.append(before)
+        if prefix:
+            pattern = prefix.lstrip('@').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            conditions.append("(CAST(UserID AS TEXT) LIKE ? ESCAPE '\\' OR Username LIKE '@' || ? ESCAPE '\\')")
+            parameters += [pattern, pattern]
+
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        order = "DESC" if before is not None else "ASC"
+        started = time.perf_counter()
+        rows = self._connection().execute(f"SELECT * FROM {table} {where}ORDER BY UserID {order} LIMIT ?",
+                                          parameters + [limit]).fetchall()
+        self._observe('page', table, started)
+        records = [self._record(table, row) for row in rows]
+        return records[::-1] if before is not None else records
+
+    def update(self, table, key, function):
+        """Replace the record with `function(record)` atomically, leaving it alone if that returns None.
+
+        `function` gets a copy of the record, or None if there is none. Returns the record as it was.
+        The read and the write share one write transaction, so other processes cannot interleave.
+        """
+        started = time.perf_counter()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(f"SELECT * FROM {table} WHERE {USER_TABLE_KEYS.get(table, 'UserID')} = ?",
+                                     (key,)).fetchone()
+            previous = self._record(table, row) if row is not None else None
+            updated = function(copy.deepcopy(previous))
+            if updated is not None:
+                self._upsert(connection, table, updated)
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        self._observe('update', table, started)
+        return previous
+
+    def increment_requests(self, user_id, requested_at):
+        """Count a download for the user, returning False if the user has no record yet."""
+        started = time.perf_counter()
+        connection = self._connection()
+        with connection:
+            counted = connection.execute("UPDATE users SET TotalRequests = TotalRequests + 1, LastRequested = ? "
+                                         "WHERE UserID = ?", (requested_at, user_id)).rowcount > 0
+        self._observe('increment', 'users', started)
+        return counted
+
+    def changed(self, table):
+        """Return True if the database file was written to since the last call for this table."""
+        signature = (file_signature(self.path), file_signature(f'{self.path}-wal'))
+        if self._signatures.get(table) == signature:
+            return False
+        self._signatures[table] = signature
+        return True
+
+
+def create_user_store():
+    if USER_STORE == 'json':
+        if SHARED_STATE:
+            raise ValueError("The cluster modes need USER_STORE=sqlite, JSON files cannot be shared between processes")
+        return JsonUserStore()
+    elif USER_STORE == 'sqlite':
+        return SqliteUserStore(USER_STORE_PATH)
+    raise ValueError(f"Unknown USER_STORE backend: {USER_STORE}")
+
+
+user_store = create_user_store()
+
+user_states = ConversationStates(STATE_TTL, STATE_MAX_SIZE, STATE_SNAPSHOT or None, STATE_SNAPSHOT_INTERVAL,
+                                 store=user_store if SHARED_STATE else None)
+conversations = ConversationFlows()
+
+
+class AccessControl:
+    """Set-based cache of super admins, admins and blocked users.
+
+    Handlers that change admins or blocks call `invalidate()`; edits made outside the bot
+    (to .env or the user store) are picked up by a change check throttled to `check_interval`.
+    """
+
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self._env_signature = None
+        self._super_admins = None
+        self._admins = None
+        self._blocked = None
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+
+        with self._lock:
+            if now < self._next_check:
+                return
+
+            env_signature = file_signature(ENV_PATH) if ENV_PATH else None
+            if self._super_admins is None or env_signature != self._env_signature:
+                if ENV_PATH:
+                    load_dotenv(ENV_PATH, override=True)
+                self._env_signature = env_signature
+                self._super_admins = frozenset(int(admin_id.strip())
+                                               for admin_id in os.getenv("SUPER_ADMIN", "").split(',')
+                                               if admin_id.strip())
+
+            if user_store.changed('admins') or self._admins is None:
+                self._admins = {admin['UserID'] for admin in user_store.all('admins')}
+            if user_store.changed('blocked') or self._blocked is None:
+                self._blocked = {blocked_user['UserID']: blocked_user['Reason']
+                                 for blocked_user in user_store.all('blocked')}
+
+            # Only now, so nobody skips the check while the first load is still running
+            self._next_check = now + self.check_interval
+
+    def invalidate(self):
+        with self._lock:
+            self._admins = {admin['UserID'] for admin in user_store.all('admins')}
+            self._blocked = {blocked_user['UserID']: blocked_user['Reason']
+                             for blocked_user in user_store.all('blocked')}
+
+    def super_admins(self):
+        self._refresh()
+        return self._super_admins
+
+    def is_admin(self, user_id):
+        self._refresh()
+        return user_id in self._admins or user_id in self._super_admins
+
+    def is_blocked(self, user_id):
+        self._refresh()
+        return user_id in self._blocked
+
+    def blocked_reason(self, user_id):
+        self._refresh()
+        return self._blocked.get(user_id)
+
+
+acl = AccessControl()
+
+
+class ChatCache:
+    """get_chat results kept for `ttl` seconds, at most `max_size` of them, least recently used dropped first.
+
+    IDs that Telegram reports as not found are cached as None for `negative_ttl` seconds. Concurrent
+    lookups of the same ID share a single API call, and a user's entry is dropped whenever they
+    message the bot, so their name and username are fetched fresh the next time.
+    """
+
+    def __init__(self, ttl, negative_ttl, max_size):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # chat ID -> (expires at, chat or None)
+        self._in_flight = {}  # chat ID -> {'done': Event, 'chat' or 'error', 'stale'}
+
+    def get(self, chat_id):
+        """Return the chat, or None if it does not exist. Other API errors are raised and not cached."""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(chat_id)
+                return entry[1]
+
+            lookup = self._in_flight.get(chat_id)
+            owner = lookup is None
+            if owner:
+                lookup = self._in_flight[chat_id] = {'done': threading.Event(), 'stale': False}
+
+        if not owner:
+            lookup['done'].wait()
+            if 'error' in lookup:
+                raise lookup['error']
+            return lookup['chat']
+
+        try:
+            try:
+                lookup['chat'], ttl = bot.get_chat(chat_id), self.ttl
+            except ApiTelegramException as e:
+                if e.error_code != 400:
+                    raise
+                lookup['chat'], ttl = None, self.negative_ttl
+        except Exception as e:
+            lookup['error'] = e
+            raise
+        else:
+            with self._lock:
+                if not lookup['stale']:
+                    self._entries[chat_id] = (time.monotonic() + ttl, lookup['chat'])
+                    self._entries.move_to_end(chat_id)
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+            return lookup['chat']
+        finally:
+            with self._lock:
+                del self._in_flight[chat_id]
+            lookup['done'].set()
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self._entries.pop(chat_id, None)
+            lookup = self._in_flight.get(chat_id)
+            if lookup is not None:
+                lookup['stale'] = True
+
+
+chat_cache = ChatCache(CHAT_CACHE_TTL, CHAT_CACHE_NEGATIVE_TTL, CHAT_CACHE_MAX_SIZE)
+
+
+def invalidate_senders(messages):
+    # A user who messages the bot may have changed their name or username since it was cached
+    for message in messages:
+        if message.from_user is not None:
+            chat_cache.invalidate(message.from_user.id)
+
+
+bot.set_update_listener(invalidate_senders)
+
+
+class TokenBucket:
+    """Blocking token bucket shared by every thread that sends through it."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Telegram allows roughly 30 messages per second across all chats
+api_rate_limiter = TokenBucket(API_RATE_LIMIT / WORKER_COUNT)
+
+
+class InboundFloodControl:
+    """Per-user token buckets for incoming updates, kept in memory only.
+
+    Each user may send `burst` updates at once and `rate` per second after that. Updates
+    beyond it are dropped, and a user who gets `mute_threshold` updates dropped before their
+    bucket fills up again is muted: everything they send in the next `mute_duration` seconds
+    is dropped too. Inline queries, which clients send on every keystroke, have a bucket of
+    their own set by `inline_rate` and `inline_burst`, and dropping them never leads to a mute.
+    Admins are never limited. In the cluster modes every user's updates go to one worker, so
+    that worker's buckets see all of them.
+    """
+
+    def __init__(self, rate, burst, mute_threshold, mute_duration, inline_rate, inline_burst):
+        self.rate = rate
+        self.burst = burst
+        self.mute_threshold = mute_threshold
+        self.mute_duration = mute_duration
+        self.inline_rate = inline_rate
+        self.inline_burst = inline_burst
+        self._lock = threading.Lock()
+        self._users = {}  # user ID -> [tokens, updated, dropped, muted until]
+        self._inline = {}  # user ID -> [tokens, updated]
+        self._next_sweep = time.monotonic() + 60
+
+    def check(self, user_id, inline=False):
+        """Return 'allow' for updates to handle, 'drop' for updates to drop and 'mute' when the user just got muted."""
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+            state = self._users.get(user_id)
+            if state is None:
+                state = self._users[user_id] = [self.burst, now, 0, 0.0]
+            if state[3] > now:
+                return 'drop'
+
+            if inline:
+                bucket = self._inline.get(user_id)
+                if bucket is None:
+                    bucket = self._inline[user_id] = [self.inline_burst, now]
+                bucket[0] = min(self.inline_burst, bucket[0] + (now - bucket[1]) * self.inline_rate)
+                bucket[1] = now
+                if bucket[0] >= 1:
+                    bucket[0] -= 1
+                    return 'allow'
+            else:
+                state[0] = min(self.burst, state[0] + (now - state[1]) * self.rate)
+                state[1] = now
+                if state[0] >= self.burst:
+                    state[2] = 0  # Quiet long enough to start over
+                if state[0] >= 1:
+                    state[0] -= 1
+                    return 'allow'
+
+        # Rare enough to afford the admin lookup outside the lock
+        if acl.is_admin(user_id):
+            return 'allow'
+        if inline:
+            return 'drop'
+
+        with self._lock:
+            state[2] += 1
+            if state[2] < self.mute_threshold:
+                return 'drop'
+            state[2] = 0
+            state[3] = now + self.mute_duration
+            return 'mute'
+
+    def _sweep(self, now):
+        """Forget the users whose buckets are full and who are not muted. Call with the lock held."""
+        self._next_sweep = now + 60
+        refill = self.burst / self.rate if self.rate else 0
+        for user_id in [user_id for user_id, state in self._users.items()
+                        if state[3] <= now and now - state[1] >= refill]:
+            del self._users[user_id]
+        inline_refill = self.inline_burst / self.inline_rate if self.inline_rate else 0
+        for user_id in [user_id for user_id, bucket in self._inline.items() if now - bucket[1] >= inline_refill]:
+            del self._inline[user_id]
+
+
+inbound_flood_control = InboundFloodControl(INBOUND_RATE, INBOUND_BURST, INBOUND_MUTE_THRESHOLD, INBOUND_MUTE_DURATION,
+                                            INBOUND_INLINE_RATE, INBOUND_INLINE_BURST)
+
+# Update types the inbound flood control looks at
+INBOUND_UPDATE_TYPES = ['message', 'edited_message', 'callback_query', 'inline_query']
+# Answer to dropped callback queries, so the button does not keep loading
+INBOUND_DROPPED_ANSWER = "Too many requests, please slow down."
+
+
+def inbound_flooded(update):
+    """Return True if the update's sender is over their inbound rate, so the update should be dropped."""
+    user = update.from_user
+    if user is None:
+        return False
+
+    verdict = inbound_flood_control.check(user.id, inline=isinstance(update, InlineQuery))
+    if verdict == 'allow':
+        return False
+
+    metrics.increment('inbound_dropped')
+    if verdict == 'mute':
+        metrics.increment('inbound_muted')
+        print(f"Muted {user.id} for {INBOUND_MUTE_DURATION:.0f} seconds for flooding")
+
+        def notify():
+            try:
+                bot.send_message(user.id, f"You are sending too many requests. Please wait "
+                                          f"{max(1, round(INBOUND_MUTE_DURATION / 60))} minutes "
+                                          f"before using the bot again.")
+            except Exception:
+                pass
+
+        # Off the calling thread, which may be the event loop in async mode
+        threading.Thread(target=notify, daemon=True).start()
+    return True
+
+
+class InboundFloodMiddleware(BaseMiddleware):
+    def __init__(self):
+        super().__init__()
+        self.update_types = INBOUND_UPDATE_TYPES
+
+    def pre_process(self, update, data):
+        if inbound_flooded(update):
+            if isinstance(update, CallbackQuery):
+                # Stop the button's loading spinner; failing only means the query has expired
+                try:
+                    bot.answer_callback_query(update.id, INBOUND_DROPPED_ANSWER)
+                except Exception:
+                    pass
+            return CancelUpdate()
+
+    def post_process(self, update, data, exception):
+        pass
+
+
+if INBOUND_RATE > 0:
+    bot.setup_middleware(InboundFloodMiddleware())
+
+
+def retry_after(exception):
+    """Return the number of seconds Telegram asked us to wait, or None if it is not a flood error."""
+    if isinstance(exception, ApiTelegramException) and exception.error_code == 429:
+        return exception.result_json.get('parameters', {}).get('retry_after', 1)
+    return None
+
+
+def call_with_retry(method, *args, retries=API_MAX_RETRIES, rate_limiter=api_rate_limiter, **kwargs):
+    """Call a Bot API method behind the rate limiter, retrying flood and transient network errors."""
+    for attempt in range(retries + 1):
+        rate_limiter.acquire()
+        try:
+            return method(*args, **kwargs)
+        except (ApiTelegramException, ApiHTTPException, requests.exceptions.RequestException) as exception:
+            if isinstance(exception, ApiTelegramException) and exception.error_code != 429:
+                raise
+            if attempt == retries:
+                raise
+            time.sleep(retry_after(exception) or 2 ** attempt)
+
+
+def is_unreachable_error(exception):
+    """Return True if Telegram refused to message a user because they blocked the bot or their chat is gone."""
+    if not isinstance(exception, ApiTelegramException):
+        return False
+    return exception.error_code == 403 or (exception.error_code == 400 and
+                                           'chat not found' in exception.result_json.get('description', '').lower())
+
+
+class Reachability:
+    """Users the bot can no longer message, because they blocked it or deleted their account.
+
+    A send that fails with such an error marks the user unreachable in the user store, and
+    broadcasts skip them from then on. The next message from the user makes them reachable
+    again. `compact` moves the records of unreachable users out of the users table, and
+    they are put back when the user returns. In the cluster modes the set is re-read
+    when the store changes, at most every `check_interval` seconds.
+    """
+
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self._unreachable = None
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+
+        with self._lock:
+            if now < self._next_check:
+                return
+            # Only other cluster processes change the table behind our back
+            if self._unreachable is None or (SHARED_STATE and user_store.changed('unreachable')):
+                self._unreachable = {record['UserID'] for record in user_store.all('unreachable')}
+            self._next_check = now + self.check_interval
+
+    def unreachable(self):
+        self._refresh()
+        with self._lock:
+            return set(self._unreachable)
+
+    def is_unreachable(self, user_id):
+        self._refresh()
+        return user_id in self._unreachable
+
+    def record_failure(self, user_id, exception):
+        """Mark the user unreachable if the failed send says so, returning True if it did."""
+        if not is_unreachable_error(exception):
+            return False
+
+        self._refresh()
+        user_store.update('unreachable', user_id, lambda record: None if record else {
+            'UserID': user_id,
+            'Reason': exception.result_json.get('description', str(exception.error_code)),
+            'Since': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'Record': None,
+        })
+        with self._lock:
+            self._unreachable.add(user_id)
+        return True
+
+    def reactivate(self, user_id):
+        if not self.is_unreachable(user_id):
+            return
+
+        record = user_store.get('unreachable', user_id)
+        if record is not None and user_store.delete('unreachable', user_id) and record['Record']:
+            user_store.upsert('users', record['Record'])  # Compacted while they were away
+        with self._lock:
+            self._unreachable.discard(user_id)
+
+    def compact(self):
+        """Move the unreachable users out of the users table, returning how many were moved."""
+        compacted = 0
+        for record in user_store.all('unreachable'):
+            user = user_store.get('users', record['UserID'])
+            if user is None:
+                continue
+            user_store.upsert('unreachable', dict(record, Record=user))
+            user_store.delete('users', record['UserID'])
+            compacted += 1
+        return compacted
+
+
+reachability = Reachability()
+
+
+def reactivate_senders(messages):
+    # Messaging the bot means the user has unblocked it
+    for message in messages:
+        if message.from_user is not None:
+            reachability.reactivate(message.from_user.id)
+
+
+bot.set_update_listener(reactivate_senders)
+
+
+class Broadcast:
+    """Copies one message to many chats from a bounded worker pool, reporting progress as it goes.
+
+    Progress is shown by editing `status_message`, which should belong to the admin's chat.
+    """
+
+    def __init__(self, source_chat_id, message_id, target_ids, status_message):
+        self.source_chat_id = source_chat_id
+        self.message_id = message_id
+        self.target_ids = list(dict.fromkeys(target_ids))  # Users that are also admins only get it once
+        unreachable = reachability.unreachable()
+        self.skipped = sum(1 for target_id in self.target_ids if target_id in unreachable)
+        self.target_ids = [target_id for target_id in self.target_ids if target_id not in unreachable]
+        self.status_message = status_message
+        self.sent = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._started = None
+
+    def _send(self, target_id):
+        try:
+            call_with_retry(bot.copy_message, target_id, self.source_chat_id, self.message_id)
+            succeeded = True
+        except Exception as e:
+            reachability.record_failure(target_id, e)
+            succeeded = False
+
+        with self._lock:
+            if succeeded:
+                self.sent += 1
+            else:
+                self.failed += 1
+
+    def progress(self):
+        with self._lock:
+            sent, failed = self.sent, self.failed
+        elapsed = max(time.monotonic() - self._started, 0.001)
+        return (f"<b>Sent:</b> {sent}\n"
+                f"<b>Failed:</b> {failed}\n"
+                f"<b>Remaining:</b> {len(self.target_ids) - sent - failed}\n"
+                f"<b>Skipped (unreachable):</b> {self.skipped}\n"
+                f"<b>Throughput:</b> {(sent + failed) / elapsed:.1f} msg/s")
+
+    def _report_progress(self):
+        while not self._done.wait(BROADCAST_PROGRESS_INTERVAL):
+            try:
+                bot.edit_message_text(f"Notifying users... please hold on.\n\n{self.progress()}",
+                                      self.status_message.chat.id, self.status_message.message_id,
+                                      parse_mode='HTML')
+            except Exception:
+                pass
+
+    def run(self):
+        self._started = time.monotonic()
+        reporter = threading.Thread(target=self._report_progress, daemon=True)
+        reporter.start()
+
+        with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) as executor:
+            for _ in executor.map(self._send, self.target_ids):
+                pass
+
+        self._done.set()
+        reporter.join()
+        bot.edit_message_text(f"All users have been notified.\n\n{self.progress()}",
+                              self.status_message.chat.id, self.status_message.message_id, parse_mode='HTML')
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+
+class DeliveryScheduler:
+    """Copies firmware and emergency files to users from a queue, at a pace Telegram accepts.
+
+    Every send goes through the global `api_rate_limiter`, and each chat gets at most `chat_rate`
+    sends per second. A chat's sends go out in the order they were queued, one at a time, so a
+    burst of downloads waits in the queue instead of failing. DownloadID lists are split into
+    copy_messages calls of at most 100 IDs, and flood or network errors are retried after the
+    `retry_after` Telegram asks for.
+    """
+
+    MAX_COPY_MESSAGES = 100
+
+    def __init__(self, workers, chat_rate, retries=API_MAX_RETRIES):
+        self.chat_interval = 1 / chat_rate
+        self.retries = retries
+        lock = threading.Lock()
+        self._condition = threading.Condition(lock)
+        self._idle = threading.Condition(lock)  # Only woken when a chat's queue empties, for wait_idle
+        self._pending = {}  # chat ID -> deque of [job, method, args, kwargs, attempts]
+        self._ready = []  # heap of (monotonic time, chat ID) for chats with sends that are not in flight
+        self._next_send = {}  # chat ID -> monotonic time of its next allowed send, for idle chats
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def deliver(self, chat_id, from_chat_id, message_ids, reply_to_message_id=None, kind='firmware'):
+        """Queue copies of `message_ids` from `from_chat_id` to `chat_id`.
+
+        The first message replies to `reply_to_message_id` and removes the reply keyboard, which
+        makes a separate placeholder message unnecessary; the rest follow in chunks of 100.
+        """
+        job = {'kind': kind, 'queued_at': time.monotonic(), 'sends': 0}
+        sends = [[job, bot.copy_message, (chat_id, from_chat_id, message_ids[0]),
+                  {'reply_to_message_id': reply_to_message_id, 'allow_sending_without_reply': True,
+                   'protect_content': True, 'reply_markup': ReplyKeyboardRemove()}, 0]]
+        for start in range(1, len(message_ids), self.MAX_COPY_MESSAGES):
+            sends.append([job, bot.copy_messages,
+                          (chat_id, from_chat_id, message_ids[start:start + self.MAX_COPY_MESSAGES]),
+                          {'protect_content': True}, 0])
+        job['sends'] = len(sends)
+
+        with self._condition:
+            if chat_id in self._pending:
+                self._pending[chat_id].extend(sends)
+            else:
+                self._pending[chat_id] = collections.deque(sends)
+                ready_at = max(job['queued_at'], self._next_send.pop(chat_id, 0))
+                heapq.heappush(self._ready, (ready_at, chat_id))
+                self._condition.notify()
+
+    def pending(self):
+        with self._condition:
+            return sum(len(sends) for sends in self._pending.values())
+
+    def wait_idle(self, timeout=None):
+        """Wait until every queued send is done, returning False if `timeout` seconds pass first."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            while self._pending:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+            return True
+
+    def _send(self, chat_id, send):
+        """Make one Bot API call, returning True when sent, False when failed or a delay to retry after."""
+        job, method, args, kwargs, attempts = send
+        api_rate_limiter.acquire()
+        try:
+            method(*args, **kwargs)
+            return True
+        except (ApiTelegramException, ApiHTTPException, requests.exceptions.RequestException) as exception:
+            flood_wait = retry_after(exception)
+            if attempts < self.retries and (flood_wait or not isinstance(exception, ApiTelegramException)):
+                send[4] += 1
+                return flood_wait or 2 ** attempts
+            failure = exception
+        except Exception as exception:
+            failure = exception
+        print(f"Failed to deliver {job['kind']} to {chat_id}: {failure}")
+        reachability.record_failure(chat_id, failure)
+        metrics.increment('delivery_errors', kind=job['kind'], error=type(failure).__name__)
+        return False
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._ready or self._ready[0][0] > time.monotonic():
+                    self._condition.wait(self._ready[0][0] - time.monotonic() if self._ready else None)
+                _, chat_id = heapq.heappop(self._ready)
+                send = self._pending[chat_id][0]
+
+            result = self._send(chat_id, send)
+
+            with self._condition:
+                now = time.monotonic()
+                sends = self._pending[chat_id]
+                job = send[0]
+                if result is True:
+                    sends.popleft()
+                    job['sends'] -= 1
+                    if not job['sends']:
+                        metrics.observe('delivery', now - job['queued_at'], kind=job['kind'])
+                    ready_at = now + self.chat_interval
+                elif result is False:
+                    # The rest of this job would most likely fail the same way (blocked bot, missing chat)
+                    while sends and sends[0][0] is job:
+                        sends.popleft()
+                    ready_at = now + self.chat_interval
+                else:
+                    ready_at = now + result
+
+                if sends:
+                    heapq.heappush(self._ready, (ready_at, chat_id))
+                    self._condition.notify()
+                else:
+                    del self._pending[chat_id]
+                    self._idle.notify_all()
+                    if len(self._next_send) > 10000:
+                        self._next_send = {key: value for key, value in self._next_send.items() if value > now}
+                    self._next_send[chat_id] = ready_at
+
+
+delivery = DeliveryScheduler(DELIVERY_WORKERS, DELIVERY_CHAT_RATE)
+
+
+class QuotaEngine:
+    """Sliding-window usage limits per role and command, kept in memory.
+
+    Every user has a list of epoch timestamps per command. A request is allowed while fewer
+    than the limit fall within the last `window` seconds. `limits` maps role to command to
+    limit; commands without a limit are unrestricted. Changed windows are written to the
+    user store every `flush_interval` seconds and on exit.
+    """
+
+    def __init__(self, limits, window, flush_interval):
+        self.limits = limits
+        self.window = window
+        self._lock = threading.Lock()
+        self._windows = {}  # user ID -> {command: [epoch seconds, oldest first]}
+        self._dirty = set()
+
+        now = int(time.time())
+        for record in user_store.all('quotas'):
+            windows = {command: [timestamp for timestamp in timestamps if timestamp > now - window]
+                       for command, timestamps in (record['Windows'] or {}).items()}
+            if any(windows.values()):
+                self._windows[record['UserID']] = windows
+
+        threading.Thread(target=self._flush_periodically, args=(flush_interval,), daemon=True).start()
+        atexit.register(self.flush)
+
+    def limit(self, role, command):
+        return self.limits.get(role, {}).get(command)
+
+    def _timestamps(self, user_id, command, now):
+        """Return the user's window for the command with expired timestamps dropped. Call with the lock held."""
+        timestamps = self._windows.get(user_id, {}).get(command, [])
+        expired = 0
+        while expired < len(timestamps) and timestamps[expired] <= now - self.window:
+            expired += 1
+        if expired:
+            del timestamps[:expired]
+            self._dirty.add(user_id)
+        return timestamps
+
+    def status(self, user_id, role, command):
+        """Return (remaining, reset_at): requests left in the window, and when the next one frees up.
+
+        Both are None for commands without a limit; reset_at is None while the window is empty.
+        """
+        limit = self.limit(role, command)
+        if limit is None:
+            return None, None
+
+        now = int(time.time())
+        with self._lock:
+            timestamps = self._timestamps(user_id, command, now)
+            return max(limit - len(timestamps), 0), timestamps[0] + self.window if timestamps else None
+
+    def record(self, user_id, command):
+        now = int(time.time())
+        with self._lock:
+            self._timestamps(user_id, command, now)
+            self._windows.setdefault(user_id, {}).setdefault(command, []).append(now)
+            self._dirty.add(user_id)
+
+    def flush(self):
+        with self._lock:
+            records = [{'UserID': user_id, 'Windows': dict(self._windows.get(user_id, {}))}
+                       for user_id in self._dirty]
+            for record in records:
+                if not any(record['Windows'].values()):
+                    self._windows.pop(record['UserID'], None)
+            self._dirty = set()
+        if records:
+            user_store.upsert_many('quotas', records)
+
+    def _flush_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to flush quotas: {e}")
+
+
+quotas = QuotaEngine(QUOTA_LIMITS, QUOTA_WINDOW, QUOTA_FLUSH_INTERVAL)
+
+
+class UploadIndex:
+    """Firmware packages seen so far, keyed by the document's file_unique_id.
+
+    Telegram keeps a file's unique ID when it is re-sent or forwarded, so it identifies a package
+    regardless of who sends it. Packages are 'submitted' when a user uploads them and 'published'
+    once they are posted to the firmware or emergency channel. The index is the user store's
+    uploads table, checked and written in one transaction so cluster workers agree on it.
+    """
+
+    def get(self, file_unique_id):
+        return user_store.get('uploads', file_unique_id)
+
+    def add(self, document, user_id, status):
+        """Record the document with the given status, returning the existing record if it was already known.
+
+        A published package stays published; a submitted one becomes published when it is posted.
+        """
+        def add_upload(existing):
+            if existing is not None and (existing['Status'] == 'published' or status == 'submitted'):
+                return None
+            return {
+                'FileUniqueID': document.file_unique_id,
+                'UserID': user_id if existing is None else existing['UserID'],
+                'FileName': document.file_name,
+                'FileSize': document.file_size,
+                'Status': status,
+                'Submitted': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            }
+
+        return user_store.update('uploads', document.file_unique_id, add_upload)
+
+    def discard(self, file_unique_id):
+        user_store.delete('uploads', file_unique_id)
+
+
+upload_index = UploadIndex()
+
+
+class UploadReviewQueue:
+    """Forwards accepted uploads to UPLOAD_CHANNEL in batches, at a rate the channel accepts.
+
+    Uploads arriving within `batch_delay` seconds of each other are forwarded together, one
+    forward_messages call per user chat, and the calls are limited to `rate` per second since
+    Telegram allows a bot about 20 messages a minute in one channel. Uploads that cannot be
+    forwarded are dropped from the upload index so they can be sent again.
+    """
+
+    MAX_FORWARD_MESSAGES = 100
+
+    def __init__(self, rate, batch_delay):
+        self.batch_delay = batch_delay
+        self.rate_limiter = TokenBucket(rate, capacity=max(1, rate))
+        self._queue = queue.Queue()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, chat_id, message_id, file_unique_id):
+        self._queue.put((chat_id, message_id, file_unique_id))
+
+    def _forward(self, chat_id, uploads):
+        self.rate_limiter.acquire()
+        try:
+            call_with_retry(bot.forward_messages, UPLOAD_CHANNEL, chat_id,
+                            sorted(message_id for message_id, _ in uploads))
+        except Exception as e:
+            print(f"Failed to forward {len(uploads)} uploads from {chat_id} for review: {e}")
+            for _, file_unique_id in uploads:
+                upload_index.discard(file_unique_id)
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_delay
+            while len(batch) < self.MAX_FORWARD_MESSAGES:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            chats = {}
+            for chat_id, message_id, file_unique_id in batch:
+                chats.setdefault(chat_id, []).append((message_id, file_unique_id))
+            for chat_id, uploads in chats.items():
+                self._forward(chat_id, uploads)
+
+
+upload_review = UploadReviewQueue(UPLOAD_REVIEW_RATE / WORKER_COUNT, UPLOAD_REVIEW_BATCH_DELAY)
+
+# Telegram rejects messages longer than this
+MESSAGE_LIMIT = 4096
+
+
+def split_message(lines, header=""):
+    """Join lines into as few messages as possible, each starting with `header` and within MESSAGE_LIMIT."""
+    messages = []
+    current = header
+    for line in lines:
+        if len(current) + len(line) > MESSAGE_LIMIT and current != header:
+            messages.append(current)
+            current = header
+        current += line
+    if current != header:
+        messages.append(current)
+    return messages
+
+
+class RequestIndex:
+    """Pending firmware requests keyed by product code, with the IDs of everyone who asked for each.
+
+    Identical requests are merged: instead of one REQUEST_CHANNEL post per /request, the codes that
+    gained requesters are posted as one digest every `digest_interval` seconds, most requested first.
+    Every `check_interval` seconds the catalog is checked for a new version; pending codes that now
+    have a DownloadID are looked up in it directly, and only their requesters are notified.
+
+    The index is the user store's requests table, changed in transactions so requests taken by
+    different cluster workers are merged. Only the process with `background` set posts digests
+    and notifications.
+    """
+
+    def __init__(self, digest_interval, check_interval, background=True):
+        self.digest_interval = digest_interval
+        self.check_interval = check_interval
+        self._catalog_version = None
+        if background:
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def add(self, product_type, product_code, user_id):
+        """Add the user to the code's requesters, returning False if they had already asked for it."""
+        def add_requester(record):
+            if record is None:
+                record = {
+                    'ProductCode': product_code,
+                    'ProductType': product_type,
+                    'Requesters': [],
+                    'Reported': 0,
+                    'Requested': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                }
+            elif user_id in record['Requesters']:
+                return None
+            record['Requesters'].append(user_id)
+            return record
+
+        previous = user_store.update('requests', product_code, add_requester)
+        return previous is None or user_id not in previous['Requesters']
+
+    def pending(self):
+        """Return the pending requests, most requested first."""
+        return sorted(user_store.all('requests'), key=lambda record: -len(record['Requesters']))
+
+    def post_digest(self):
+        """Post the requests that gained requesters since the last digest to REQUEST_CHANNEL."""
+        records = [record for record in self.pending() if len(record['Requesters']) > record['Reported']]
+        if not records:
+            return
+
+        lines = [f"{rank}. <code>{record['ProductType']}</code> <code>{record['ProductCode']}</code>: "
+                 f"requested by {len(record['Requesters'])} (+{len(record['Requesters']) - record['Reported']})\n"
+                 for rank, record in enumerate(records, 1)]
+        for text in split_message(lines, "<b>Firmware Requests</b>\n\n"):
+            call_with_retry(bot.send_message, REQUEST_CHANNEL, text, parse_mode='HTML')
+
+        for posted in records:
+            user_store.update('requests', posted['ProductCode'],
+                              lambda record: dict(record, Reported=len(posted['Requesters'])) if record else None)
+
+    def notify_fulfilled(self):
+        """Notify the requesters of codes that were added to the catalog since the last check."""
+        version = catalog.current_version()
+        if version == self._catalog_version:
+            return
+        self._catalog_version = version
+
+        fulfilled = []
+        for record in user_store.all('requests'):
+            _, entry = catalog.product_code(record['ProductCode'])
+            if entry is not None and entry['DownloadID'] and user_store.delete('requests', record['ProductCode']):
+                fulfilled.append(record)
+
+        for record in fulfilled:
+            for user_id in record['Requesters']:
+                if reachability.is_unreachable(user_id):
+                    continue
+                try:
+                    call_with_retry(bot.send_message, user_id,
+                                    f"The firmware you requested for product type <code>{record['ProductType']}</code> "
+                                    f"with product code <code>{record['ProductCode']}</code> has been added to the "
+                                    f"repository. Use /download to get it.", parse_mode='HTML')
+                except Exception as e:
+                    reachability.record_failure(user_id, e)
+
+    def _run(self):
+        next_digest = time.monotonic() + self.digest_interval
+        while True:
+            try:
+                self.notify_fulfilled()
+                if time.monotonic() >= next_digest:
+                    next_digest = time.monotonic() + self.digest_interval
+                    self.post_digest()
+            except Exception as e:
+                print(f"Failed to process firmware requests: {e}")
+            time.sleep(self.check_interval)
+
+
+request_index = RequestIndex(REQUEST_DIGEST_INTERVAL, REQUEST_CHECK_INTERVAL, background=BACKGROUND_JOBS)
+
+
+class DownloadStats:
+    """Download counts per product code, product type and emergency package, rolled up by hour and day.
+
+    Downloads are counted in memory and added to the user store's downloads table every
+    `flush_interval` seconds and on exit, one row per period, bucket start, kind and name. The
+    rows are also kept in memory, indexed by period, kind and bucket start, so /top only sums
+    the buckets it reports on. Hourly rows are kept for `hourly_retention` hours and daily rows
+    for `daily_retention` days.
+    """
+
+    PERIODS = {'hour': 3600, 'day': 86400}
+
+    def __init__(self, flush_interval, hourly_retention, daily_retention):
+        self.retention = {'hour': hourly_retention * 3600, 'day': daily_retention * 86400}
+        self._lock = threading.Lock()
+        self._pending = collections.Counter()  # (kind, name, hour start) -> downloads not flushed yet
+        self._rollups = {}  # (period, kind) -> {bucket start: {name: downloads}}
+        self._next_prune = 0
+        self.reload()
+
+        threading.Thread(target=self._flush_periodically, args=(flush_interval,), daemon=True).start()
+        atexit.register(self.flush)
+
+    def reload(self):
+        """Read the rollups from the user store, picking up the counts flushed by other processes."""
+        rollups = {}
+        for record in user_store.all('downloads'):
+            buckets = rollups.setdefault((record['Period'], record['Kind']), {})
+            buckets.setdefault(record['Start'], {})[record['Name']] = record['Count']
+        with self._lock:
+            self._rollups = rollups
+
+    def record(self, kind, name):
+        now = int(time.time())
+        with self._lock:
+            self._pending[(kind, name, now - now % 3600)] += 1
+
+    def _add(self, period, start, kind, name, count):
+        bucket = f"{period}:{start}:{kind}:{name}"
+        previous = user_store.update('downloads', bucket, lambda record: dict(record, Count=record['Count'] + count)
+                                     if record else {'Bucket': bucket, 'Period': period, 'Start': start,
+                                                     'Kind': kind, 'Name': name, 'Count': count})
+        with self._lock:
+            buckets = self._rollups.setdefault((period, kind), {})
+            buckets.setdefault(start, {})[name] = (previous['Count'] if previous else 0) + count
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, collections.Counter()
+
+        items = list(pending.items())
+        for position, ((kind, name, hour), count) in enumerate(items):
+            try:
+                self._add('hour', hour, kind, name, count)
+                self._add('day', hour - hour % 86400, kind, name, count)
+            except Exception:
+                # Count what is left again on the next flush
+                with self._lock:
+                    self._pending.update(dict(items[position:]))
+                raise
+
+        if time.time() >= self._next_prune:
+            self._next_prune = time.time() + 3600
+            self.prune()
+
+    def prune(self):
+        """Drop the rollups that are older than their period's retention."""
+        now = int(time.time())
+        expired = []
+        with self._lock:
+            for (period, kind), buckets in self._rollups.items():
+                for start in [start for start in buckets if start < now - self.retention[period]]:
+                    expired += [f"{period}:{start}:{kind}:{name}" for name in buckets.pop(start)]
+        for bucket in expired:
+            user_store.delete('downloads', bucket)
+
+    def top(self, kind, days, limit):
+        """Return up to `limit` (name, downloads, downloads in the `days` before, downloads in the last 24 hours).
+
+        Names are ordered by their downloads over the last `days` days, today included.
+        """
+        now = int(time.time())
+        today = now - now % 86400
+        hour = now - now % 3600
+        current, previous, last_day = collections.Counter(), collections.Counter(), collections.Counter()
+        with self._lock:
+            days_buckets = self._rollups.get(('day', kind), {})
+            for day in range(days):
+                current.update(days_buckets.get(today - day * 86400, {}))
+                previous.update(days_buckets.get(today - (days + day) * 86400, {}))
+            hours_buckets = self._rollups.get(('hour', kind), {})
+            for hours in range(24):
+                last_day.update(hours_buckets.get(hour - hours * 3600, {}))
+
+            for (pending_kind, name, pending_hour), count in self._pending.items():
+                if pending_kind != kind:
+                    continue
+                age = (today - (pending_hour - pending_hour % 86400)) // 86400
+                if age < days:
+                    current[name] += count
+                elif age < 2 * days:
+                    previous[name] += count
+                if pending_hour > hour - 24 * 3600:
+                    last_day[name] += count
+
+        return [(name, count, previous[name], last_day[name]) for name, count in current.most_common(limit)]
+
+    def _flush_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to flush download stats: {e}")
+
+
+download_stats = DownloadStats(ANALYTICS_FLUSH_INTERVAL, ANALYTICS_HOURLY_RETENTION, ANALYTICS_DAILY_RETENTION)
+
+
+def export_user_store():
+    """Write the users, admins and blocked users back to their JSON files, in the original format."""
+    file_names = [USER_TABLES[table] for table in ('users', 'admins', 'blocked')]
+    for table in ('users', 'admins', 'blocked'):
+        write_json_atomic(USER_TABLES[table], user_store.all(table), indent=4)
+    return [f'{current_dir}/{file_name}' for file_name in file_names]
 
 
 def is_user_id_valid(user_id, chat, check_exist=True):
@@ -48,8 +2389,10 @@ def is_user_id_valid(user_id, chat, check_exist=True):
         int(user_id)
         if check_exist:
             try:
-                bot.get_chat(int(user_id))
+                exists = chat_cache.get(int(user_id)) is not None
             except:
+                exists = False
+            if not exists:
                 bot.reply_to(chat, "This user ID does not exist.")
                 return False
 
@@ -60,8 +2403,7 @@ def is_user_id_valid(user_id, chat, check_exist=True):
 
 
 def is_user_admin(user):
-    admins = load_json('admins.json')
-    if any(admin['UserID'] == user.from_user.id for admin in admins) or user.from_user.id in super_admins():
+    if acl.is_admin(user.from_user.id):
         return True
     else:
         bot.reply_to(user, "You do not have admin privileges to use this request.")
@@ -69,207 +2411,360 @@ def is_user_admin(user):
 
 
 def is_user_admin_by_id(user_id):
-    admins = load_json('admins.json')
-    if any(admin['UserID'] == user_id for admin in admins) or user_id in super_admins():
+    if acl.is_admin(user_id):
         return True
     else:
         return False
 
 
+def blocked_response(user):
+    if acl.is_blocked(user.from_user.id):
+        return {'text': f"You have been blocked. Use /unblock to request to be unblocked.\n\n<b>"
+                        f"Reason:</b> {acl.blocked_reason(user.from_user.id)}.",
+                'parse_mode': 'HTML'}
+    return None
+
+
 def is_user_blocked(user):
-    blocked_users = load_json('blocked.json')
-    for blocked_user in blocked_users:
-        if blocked_user['UserID'] == user.from_user.id:
-            bot.reply_to(user, f"You have been blocked. Use /unblock to request to be unblocked.\n\n<b>"
-                               f"Reason:</b> {blocked_user['Reason']}.",
-                         parse_mode='HTML')
-            return True
+    response = blocked_response(user)
+    if response is not None:
+        send_response(user, response)
+        return True
     return False
 
 
-def check_user_limit(user_info):
-    time_left = None
-    users = load_json('users.json')
-    current_time = datetime.now()
-    user_requests = next((user for user in users if user['UserID'] == user_info.id), None)
+def send_response(message, response):
+    """Send a response returned by a `responds` handler: a dict of send_message arguments, replying to the
+    message unless `quote` is False."""
+    if response is None:
+        return None
+    options = dict(response)
+    text = options.pop('text')
+    if options.pop('quote', True):
+        return bot.reply_to(message, text, **options)
+    return bot.send_message(message.chat.id, text, **options)
 
-    if user_requests is None:
-        user_requests = {'UserID': user_info.id, "Fullname": user_info.full_name,
-                         'Username': f"{'@' + user_info.username if user_info.username else ''}",
-                         'Bot': user_info.is_bot, 'TotalRequests': 0,
-                         'LastRequested': current_time.strftime("%Y-%m-%d %H:%M:%S")}
-        users.append(user_requests)
-    elif current_time > datetime.strptime(user_requests['LastRequested'], "%Y-%m-%d %H:%M:%S") + timedelta(days=1):
-        user_requests['TotalRequests'] = 0  # Reset count for a new day
-    else:
-        time_left = (datetime.strptime(user_requests['LastRequested'], "%Y-%m-%d %H:%M:%S")
-                     + timedelta(days=1) - current_time)
 
-    if user_requests['TotalRequests'] >= 2:
-        return False, user_requests, time_left  # Limit reached
-    else:
-        user_requests['LastRequested'] = current_time.strftime("%Y-%m-%d %H:%M:%S")
+def responds(function):
+    """Decorator for handlers that return their reply instead of sending it.
+
+    The handler itself does the catalog and store work and sends nothing, so async mode can run it
+    off the event loop and send its response there without holding a thread during the API call.
+    """
+    @functools.wraps(function)
+    def handler(message):
+        send_response(message, function(message))
+    handler.respond = function
+    return handler
+
 
-    dump_json('users.json', users)
+def user_role(user_id):
+    return 'admin' if is_user_admin_by_id(user_id) else 'user'
 
-    return True, user_requests, time_left
 
+def check_user_limit(user_info, command='download'):
+    remaining, reset_at = quotas.status(user_info.id, user_role(user_info.id), command)
 
-def save_user_data(user_info):
-    users = load_json('users.json')
-    user_requests = next((user for user in users if user['UserID'] == user_info.id), None)
+    if remaining == 0:
+        return False, timedelta(seconds=max(reset_at - time.time(), 0))  # Limit reached
 
-    if user_requests is not None:
-        user_requests['TotalRequests'] += 1  # Increment the count
+    return True, None
 
-    dump_json('users.json', users)
+
+def save_user_data(user_info, command='download'):
+    quotas.record(user_info.id, command)
+
+    if is_user_admin_by_id(user_info.id):
+        return
+
+    requested_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if not user_store.increment_requests(user_info.id, requested_at):  # Increment the count
+        user_store.upsert('users', {'UserID': user_info.id, "Fullname": user_info.full_name,
+                                    'Username': f"{'@' + user_info.username if user_info.username else ''}",
+                                    'Bot': user_info.is_bot, 'TotalRequests': 1, 'LastRequested': requested_at})
+
+
+def upload_problem(message):
+    """Return why an uploaded firmware package can't be accepted, or None if it can."""
+    document = message.document
+    if document.mime_type != "application/zip" or not (document.file_name or "").lower().endswith(".zip"):
+        return "Sorry, the firmware package must be in ZIP format."
+    if not document.file_size or document.file_size > UPLOAD_MAX_SIZE:
+        return f"Sorry, the firmware package must not be empty or larger than {UPLOAD_MAX_SIZE // 1024 ** 2} MB."
+    if not (message.caption or "").strip():
+        return "Sorry, the firmware package must include a caption that specifies its product type and product code."
+    return None
+
+
+def format_admin(admin):
+    return (f"UserID: <code>{admin['UserID']}</code>\n"
+            f"Fullname: <code>{html.escape(admin['Fullname'])}</code>\n"
+            f"Username: {html.escape(admin['Username'] or '')}\n\n")
+
+
+def format_blocked_user(blocked_user):
+    return (f"UserID: <code>{blocked_user['UserID']}</code>\n"
+            f"Fullname: <code>{html.escape(blocked_user['Fullname'])}</code>\n"
+            f"Username: {html.escape(blocked_user['Username'] or '')}\n"
+            f"Reason: <code>{html.escape(blocked_user['Reason'][:1000])}</code>\n\n")
+
+
+# Listing kind -> (table, title, record formatter, text when empty, footer)
+USER_LISTS = {
+    'admins': ('admins', "Admin Users", format_admin, "There are currently no admins to display.\n"
+               "Super admins will not be listed here.",
+               "\nNote that super admins will not be listed here."),
+    'blocked': ('blocked', "Blocked Users", format_blocked_user, "There are no blocked users yet.", ""),
+}
+
+
+def render_user_list(kind, prefix="", after=None, before=None):
+    """Render one page of an admin listing as (text, reply markup).
+
+    Records are read from the store LIST_PAGE_SIZE at a time, and the page holds as many of them
+    as fit in one message. "Prev" and "Next" buttons carry the first and last UserID shown,
+    so the neighbouring pages are read starting from there.
+    """
+    table, title, format_record, empty_text, footer = USER_LISTS[kind]
+    prefix = prefix.encode()[:32].decode(errors='ignore')  # Keeps the callback data within 64 bytes
+    header = f"<b>{title}</b>\n" + (f"Matching <code>{html.escape(prefix)}</code>\n\n" if prefix else "")
+    records = user_store.page(table, after=after, before=before, limit=LIST_PAGE_SIZE + 1, prefix=prefix or None)
+    more = len(records) > LIST_PAGE_SIZE
+    records = records[-LIST_PAGE_SIZE:] if before is not None else records[:LIST_PAGE_SIZE]
+
+    # Fill the page from the side it was paged towards, stopping before it outgrows one message
+    ordered = records[::-1] if before is not None else records
+    shown = []
+    length = len(header) + len(footer)
+    for record in ordered:
+        line = format_record(record)
+        if shown and length + len(line) > MESSAGE_LIMIT:
+            more = True
+            break
+        shown.append((record, line))
+        length += len(line)
+    if before is not None:
+        shown.reverse()
+
+    if not shown:
+        if prefix:
+            return f"{header}Nothing matches this filter.", None
+        return f"{header}{empty_text}", None
+
+    has_previous, has_next = (more, True) if before is not None else (after is not None, more)
+    buttons = []
+    if has_previous:
+        buttons.append(InlineKeyboardButton("« Prev", callback_data=f"ul:{kind}:p:{shown[0][0]['UserID']}:{prefix}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next »", callback_data=f"ul:{kind}:n:{shown[-1][0]['UserID']}:{prefix}"))
+    markup = InlineKeyboardMarkup().row(*buttons) if buttons else None
+
+    return header + "".join(line for _, line in shown) + footer, markup
+
+
+def format_time_left(time_left):
+    hours, remainder = divmod(time_left.total_seconds(), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{int(hours)} hours, {int(minutes) + 1} minutes"
 
 
 @bot.message_handler(commands=['start'])
+@responds
 def send_welcome(message):
-    if is_user_blocked(message):
-        return
+    blocked = blocked_response(message)
+    if blocked is not None:
+        return blocked
 
-    users = load_json('users.json')
-    user_requests = next((user for user in users if user['UserID'] == message.from_user.id), None)
+    user_requests = user_store.get('users', message.from_user.id)
 
     if user_requests is None:
         user_requests = {'UserID': message.from_user.id, "Fullname": message.from_user.full_name,
                          'Username': f"{'@' + message.from_user.username if message.from_user.username else ''}",
                          'Bot': message.from_user.is_bot, 'TotalRequests': 0,
                          'LastRequested': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-        users.append(user_requests)
 
-        bot.send_message(message.chat.id,
-                         'Hey there <a href="tg://user?id={}">{}</a>, and welcome to the Lumia Firmware Download Bot! '
-                         'Use /download to get started with me.'.format(
-                             message.from_user.id, message.from_user.first_name), parse_mode='HTML')
-
-        if is_user_admin_by_id(message.from_user.id):
-            return
+        if not is_user_admin_by_id(message.from_user.id):
+            user_store.upsert('users', user_requests)
 
-        dump_json('users.json', users)
+        return {'text': 'Hey there <a href="tg://user?id={}">{}</a>, and welcome to the Lumia Firmware Download Bot! '
+                        'Use /download to get started with me.'.format(
+                            message.from_user.id, message.from_user.first_name),
+                'parse_mode': 'HTML', 'quote': False}
     else:
-        bot.send_message(message.chat.id,
-                         'Hey there <a href="tg://user?id={}">{}</a>, '
-                         'and welcome back to the Lumia Firmware Download Bot! Use /download to get started with me.'
-                         .format(message.from_user.id, message.from_user.first_name), parse_mode='HTML')
+        return {'text': 'Hey there <a href="tg://user?id={}">{}</a>, '
+                        'and welcome back to the Lumia Firmware Download Bot! Use /download to get started with me.'
+                        .format(message.from_user.id, message.from_user.first_name),
+                'parse_mode': 'HTML', 'quote': False}
 
 
 @bot.message_handler(commands=['download'])
+@responds
 def download_firmware(message):
-    if is_user_blocked(message):
-        return
+    blocked = blocked_response(message)
+    if blocked is not None:
+        return blocked
 
-    if not is_user_admin_by_id(message.from_user.id):
-        allowed, user_requests, time_left = check_user_limit(message.from_user)
-        if not allowed:
-            hours, remainder = divmod(time_left.total_seconds(), 3600)
-            minutes, seconds = divmod(remainder, 60)
-            bot.reply_to(message, f"You have reached your limit of download requests. "
-                                  f"You can download again in {int(hours)} hours, {int(minutes) + 1} minutes.",
-                         parse_mode='HTML')
-            return
+    allowed, time_left = check_user_limit(message.from_user, 'download')
+    if not allowed:
+        return {'text': f"You have reached your limit of download requests. "
+                        f"You can download again in {format_time_left(time_left)}.",
+                'parse_mode': 'HTML'}
 
-    markup = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True, row_width=2)
-    devices = load_json('devices.json')
-    buttons = [
-        KeyboardButton(device['ProductType'])
-        for device in devices
-        if any(product_codes['DownloadID'] for product_codes in device['ProductCodes'])
-    ]
-    markup.add(*buttons)
-    bot.reply_to(message, "Select your Lumia product type.\nUse /cancel to cancel the action.", reply_markup=markup)
+    # Set the user state to indicate they're in the download process, before the reply can be answered
+    conversations.start(message.from_user.id, 'awaiting_product_type')
 
-    # Set the user state to indicate they're in the download process
-    user_states[message.from_user.id] = 'awaiting_product_type'
+    return {'text': "Select your Lumia product type.\nUse /cancel to cancel the action.",
+            'reply_markup': keyboards.get('types')}
 
 
 @bot.message_handler(commands=['upload'])
+@responds
 def upload_firmware(message):
-    if is_user_blocked(message):
-        return
+    blocked = blocked_response(message)
+    if blocked is not None:
+        return blocked
 
-    user_states[message.from_user.id] = 'awaiting_upload_firmware'
-    bot.reply_to(message, "Please send or forward your firmware package in ZIP format, "
-                          "including a caption that specifies the firmware product type and product code. "
-                          "You may also include any relevant messages if you wish. "
-                          "Packages that do not meet these requirements, such as ZIP format and the necessary caption, "
-                          "will be rejected.\n"
-                          "Use /cancel to cancel the action.\n\n"
-                          "Note that sending or forwarding irrelevant files may result in you being blocked.",
-                 reply_markup=ReplyKeyboardRemove())
+    conversations.start(message.from_user.id, 'awaiting_upload_firmware')
+    return {'text': "Please send or forward your firmware package in ZIP format, "
+                    "including a caption that specifies the firmware product type and product code. "
+                    "You may also include any relevant messages if you wish. "
+                    "Packages that do not meet these requirements, such as ZIP format and the necessary caption, "
+                    "will be rejected.\n"
+                    "Use /cancel to cancel the action.\n\n"
+                    "Note that sending or forwarding irrelevant files may result in you being blocked.",
+            'reply_markup': ReplyKeyboardRemove()}
 
 
 @bot.message_handler(commands=['request'])
+@responds
 def request_firmware(message):
-    if is_user_blocked(message):
-        return
+    blocked = blocked_response(message)
+    if blocked is not None:
+        return blocked
 
     params = message.text.split()
 
     # Check if the correct number of arguments are provided
     if len(params) < 3:
-        bot.reply_to(message,
-                     "<b>Usage:</b>\n\t\t/request &lt;ProductType&gt; "
-                     "&lt;ProductCode&gt;\n\n<b>Example:</b>\n\t\t<code>/request RM-1085 059X4T0</code>\n\n"
-                     "Note that abusing this feature will result in you being blocked.",
-                     parse_mode='HTML')
-        return
+        return {'text': "<b>Usage:</b>\n\t\t/request &lt;ProductType&gt; "
+                        "&lt;ProductCode&gt;\n\n<b>Example:</b>\n\t\t<code>/request RM-1085 059X4T0</code>\n\n"
+                        "Note that abusing this feature will result in you being blocked.",
+                'parse_mode': 'HTML'}
 
     product_type = params[1].upper()
     product_code = params[2].upper()
 
-    devices = load_json('devices.json')
-    device = next((d for d in devices if d['ProductType'] == product_type), None)
+    device = catalog.device(product_type)
     valid_product_type = device is not None
     valid_product_code = False
     already_exists = False
 
     if valid_product_type:
-        product_codes = device['ProductCodes']
-        code = next((pc for pc in product_codes if pc['ProductCode'] == product_code), None)
-        valid_product_code = code is not None
-        already_exists = code['DownloadID'] is not None if code['DownloadID'] else False
+        code_device, code = catalog.product_code(product_code)
+        valid_product_code = code_device is device
+        already_exists = bool(code['DownloadID']) if valid_product_code else False
 
     if not valid_product_type:
-        bot.reply_to(message, "Please enter a valid product type.")
+        return {'text': "Please enter a valid product type."}
     elif not valid_product_code:
-        bot.reply_to(message, "Please enter a valid product code.")
+        return {'text': "Please enter a valid product code."}
     elif already_exists:
-        bot.reply_to(message, f"The requested firmware for product type `{product_type}` with "
-                              f"product code `{product_code}` is already in the repository\.",
-                     parse_mode='MarkdownV2')
+        return {'text': f"The requested firmware for product type `{product_type}` with "
+                        f"product code `{product_code}` is already in the repository\.",
+                'parse_mode': 'MarkdownV2'}
+    elif not request_index.add(product_type, product_code, message.from_user.id):
+        return {'text': f"You have already requested the firmware for product type `{product_type}` with "
+                        f"product code `{product_code}`\. We will notify you as soon as it is added\.",
+                'parse_mode': 'MarkdownV2'}
     else:
-        bot.send_message(REQUEST_CHANNEL, f"<b>User ID:</b> <code>{message.from_user.id}</code>\n"
-                                          f"<b>Fullname:</b> <code>{message.from_user.full_name}</code>\n"
-                                          f"<b>Username:</b> {'@' + message.from_user.username if message.from_user.username else ''}\n"
-                                          f"<b>Product Type:</b> <code>{product_type}</code>\n"
-                                          f"<b>Product Code:</b> <code>{product_code}</code>",
-                         parse_mode='HTML')
-        bot.reply_to(message, f"Your request has been accepted\. We will add the firmware for "
-                              f"product type `{product_type}` with product code `{product_code}` "
-                              f"as soon as possible and will notify you\.",
-                     parse_mode='MarkdownV2')
+        return {'text': f"Your request has been accepted\. We will add the firmware for "
+                        f"product type `{product_type}` with product code `{product_code}` "
+                        f"as soon as possible and will notify you\.",
+                'parse_mode': 'MarkdownV2'}
+
+
+@bot.message_handler(commands=['search'])
+@responds
+def search_firmware(message):
+    blocked = blocked_response(message)
+    if blocked is not None:
+        return blocked
+
+    params = message.text.split(' ', 1)
+
+    if len(params) < 2 or not params[1].strip():
+        return {'text': "<b>Usage:</b>\n\t\t/search &lt;Query&gt;\n\n"
+                        "<b>Example:</b>\n\t\t<code>/search Lumia 640</code>",
+                'parse_mode': 'HTML'}
+
+    results = search_index.search(params[1])
+
+    if results:
+        return {'text': "<b>Search Results</b>\n" + "\n".join(format_search_result(device, entry)
+                                                               for device, entry in results),
+                'parse_mode': 'HTML'}
+    else:
+        return {'text': "No product types or product codes matched your search."}
+
+
+def inline_search_results(query):
+    if not query.query.strip() or acl.is_blocked(query.from_user.id):
+        return []
+
+    results = []
+    for number, (device, entry) in enumerate(search_index.search(query.query, limit=20)):
+        title = device['ProductType'] if entry is None else f"{device['ProductType']} {entry['ProductCode']}"
+        results.append(InlineQueryResultArticle(
+            str(number), title,
+            InputTextMessageContent(format_search_result(device, entry), parse_mode='HTML'),
+            description=device['ModelName'] if entry is None else entry['PackageTitle']))
+    return results
+
+
+@bot.inline_handler(func=lambda query: True)
+def handle_inline_search(query):
+    bot.answer_inline_query(query.id, inline_search_results(query), cache_time=300)
 
 
 @bot.message_handler(commands=['emergency_files'])
+@responds
 def get_emergency_files(message):
-    if is_user_blocked(message):
-        return
+    blocked = blocked_response(message)
+    if blocked is not None:
+        return blocked
+
+    allowed, time_left = check_user_limit(message.from_user, 'emergency_files')
+    if not allowed:
+        return {'text': f"You have reached your limit of emergency file requests. "
+                        f"You can request them again in {format_time_left(time_left)}."}
 
-    markup = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True, row_width=2)
-    devices = load_json('devices.json')
-    buttons = [
-        KeyboardButton(device['ProductType'])
-        for device in devices
-        if device['Emergency']["DownloadID"]
-    ]
-    markup.add(*buttons)
-    bot.reply_to(message, "Select your Lumia product type.\nUse /cancel to cancel the action.", reply_markup=markup)
+    # Set the user state to indicate they're in the download process, before the reply can be answered
+    conversations.start(message.from_user.id, 'awaiting_emergency_files')
 
-    # Set the user state to indicate they're in the download process
-    user_states[message.from_user.id] = 'awaiting_emergency_files'
+    return {'text': "Select your Lumia product type.\nUse /cancel to cancel the action.",
+            'reply_markup': keyboards.get('emergency')}
+
+
+@bot.message_handler(commands=['quota'])
+@responds
+def show_quota(message):
+    blocked = blocked_response(message)
+    if blocked is not None:
+        return blocked
+
+    role = user_role(message.from_user.id)
+    content = str()
+    for command in ('download', 'emergency_files'):
+        remaining, reset_at = quotas.status(message.from_user.id, role, command)
+        if remaining is None:
+            content += f"/{command}: unlimited\n"
+        elif reset_at is None:
+            content += f"/{command}: {remaining} of {quotas.limit(role, command)} left\n"
+        else:
+            content += (f"/{command}: {remaining} of {quotas.limit(role, command)} left, next one frees up in "
+                        f"{format_time_left(timedelta(seconds=max(reset_at - time.time(), 0)))}\n")
+
+    return {'text': f"<b>Your Quota</b>\n{content}", 'parse_mode': 'HTML'}
 
 
 @bot.message_handler(commands=['unblock'])
@@ -305,25 +2800,22 @@ def add_admin(message):
                      parse_mode='HTML')
         return
 
-    admins = load_json('admins.json')
-
     if not is_user_id_valid(params[1], message):
         return
 
     user_id = int(params[1])
 
-    blocked_users = load_json('blocked.json')
-    if any(blocked_user["UserID"] == user_id for blocked_user in blocked_users):
+    if acl.is_blocked(user_id):
         bot.reply_to(message, "You cannot promote a user who is blocked from using the bot.")
         return
 
-    if user_id not in admins and user_id not in super_admins():
-        user = bot.get_chat(user_id)
+    if not acl.is_admin(user_id):
+        user = chat_cache.get(user_id)
 
-        admins.append({'UserID': user.id,
-                       'Fullname': f"{user.first_name}{' ' + user.last_name if user.last_name else ''}",
-                       'Username': f"{'@' + user.username if user.username else ''}"})
-        dump_json('admins.json', admins)
+        user_store.upsert('admins', {'UserID': user.id,
+                                     'Fullname': f"{user.first_name}{' ' + user.last_name if user.last_name else ''}",
+                                     'Username': f"{'@' + user.username if user.username else ''}"})
+        acl.invalidate()
 
         bot.reply_to(message, "The user has been promoted to admin privileges.")
     else:
@@ -344,8 +2836,6 @@ def remove_admin(message):
                      parse_mode='HTML')
         return
 
-    admins = load_json('admins.json')
-
     if not is_user_id_valid(params[1], message, False):
         return
 
@@ -354,10 +2844,8 @@ def remove_admin(message):
     if user_id in super_admins():
         bot.reply_to(message, "You cannot demote a super admin.")
         return
-    elif any(admin['UserID'] == user_id for admin in admins):
-        admins = [admin for admin in admins if admin['UserID'] != user_id]
-        dump_json('admins.json', admins)
-
+    elif user_store.delete('admins', user_id):
+        acl.invalidate()
         bot.reply_to(message, "The user has been demoted from admin privileges.")
     else:
         bot.reply_to(message, "The user is already not an admin.")
@@ -393,30 +2881,30 @@ def notify_users(message):
         bot.reply_to(message, "Only super admin can use this request.")
         return
 
-    user_states[message.from_user.id] = 'awaiting_forward_message'
+    conversations.start(message.from_user.id, 'awaiting_forward_message')
     bot.reply_to(message, "Send or forward the message you would like to notify.\nUse /cancel to cancel the action.",
                  reply_markup=ReplyKeyboardRemove())
 
 
+@bot.message_handler(commands=['export_users'])
+def export_users(message):
+    if message.chat.id not in super_admins():
+        bot.reply_to(message, "Only super admin can use this request.")
+        return
+
+    for file_path in export_user_store():
+        with open(file_path, 'rb') as json_file:
+            bot.send_document(message.chat.id, json_file)
+
+
 @bot.message_handler(commands=['list_admins'])
 def list_admins(message):
     if not is_user_admin(message):
         return
 
-    admins = load_json('admins.json')
-
-    content = str()
-    for admin in admins:
-        content += (f"UserID: <code>{admin['UserID']}</code>\n"
-                    f"Fullname: <code>{admin['Fullname']}</code>\n"
-                    f"Username: {admin['Username']}\n\n")
-
-    if admins:
-        bot.reply_to(message, f"<b>Admin Users</b>\n{content}\nNote that super admins will not be listed here.",
-                     parse_mode='HTML')
-    else:
-        bot.reply_to(message, "<b>Admin Users</b>\nThere are currently no admins to display.\n"
-                              "Super admins will not be listed here.", parse_mode='HTML')
+    # An optional UserID or username prefix narrows the list down
+    text, markup = render_user_list('admins', " ".join(message.text.split()[1:2]))
+    bot.reply_to(message, text, parse_mode='HTML', reply_markup=markup)
 
 
 @bot.message_handler(commands=['get_id'])
@@ -424,7 +2912,7 @@ def get_user_id(message):
     if not is_user_admin(message):
         return
 
-    user_states[message.from_user.id] = 'awaiting_user_message'
+    conversations.start(message.from_user.id, 'awaiting_user_message')
     bot.reply_to(message, "Please forward a message from the user you wish to retrieve their user ID.\n"
                           "Use /cancel to cancel the action.", reply_markup=ReplyKeyboardRemove())
 
@@ -447,7 +2935,7 @@ def get_user_info(message):
 
     user_id = int(params[1])
 
-    user = bot.get_chat(user_id)
+    user = chat_cache.get(user_id)
     bot.reply_to(message,
                  f"<b>Fullname:</b> <code>{user.first_name}{' ' + user.last_name if user.last_name else ''}</code>\n"
                  f"<b>Username:</b> {'@' + user.username if user.username else ''}\n"
@@ -477,19 +2965,16 @@ def block_user(message):
         bot.reply_to(message, "You're unable to block an admin.")
         return
 
-    blocked_users = load_json('blocked.json')
-
-    for blocked_user in blocked_users:
-        if blocked_user['UserID'] == user_id:
-            bot.reply_to(message, "The user has already been blocked.")
-            return
+    if acl.is_blocked(user_id):
+        bot.reply_to(message, "The user has already been blocked.")
+        return
 
-    user = bot.get_chat(user_id)
-    blocked_users.append({'UserID': user.id,
-                          'Fullname': f"{user.first_name}{' ' + user.last_name if user.last_name else ''}",
-                          'Username': f"{'@' + user.username if user.username else ''}",
-                          'Reason': " ".join(message.text.split()[2:])})
-    dump_json('blocked.json', blocked_users)
+    user = chat_cache.get(user_id)
+    user_store.upsert('blocked', {'UserID': user.id,
+                                  'Fullname': f"{user.first_name}{' ' + user.last_name if user.last_name else ''}",
+                                  'Username': f"{'@' + user.username if user.username else ''}",
+                                  'Reason': " ".join(message.text.split()[2:])})
+    acl.invalidate()
 
     bot.reply_to(message, f"Successfully blocked the user ID `{params[1]}`", parse_mode='MarkdownV2')
 
@@ -507,19 +2992,15 @@ def unblock_user(message):
                      parse_mode='HTML')
         return
 
-    blocked_users = load_json('blocked.json')
-
     if not is_user_id_valid(params[1], message, False):
         return
 
     user_id = int(params[1])
 
-    if not any(blocked_user["UserID"] == user_id for blocked_user in blocked_users):
+    if not user_store.delete('blocked', user_id):
         bot.reply_to(message, "The user is not blocked, so there is no need to unblock them.")
         return
-
-    blocked_users = [blocked_user for blocked_user in blocked_users if blocked_user["UserID"] != user_id]
-    dump_json('blocked.json', blocked_users)
+    acl.invalidate()
 
     bot.reply_to(message, f"Successfully unblocked the user ID `{params[1]}`", parse_mode='MarkdownV2')
 
@@ -529,19 +3010,9 @@ def blocked_users_list(message):
     if not is_user_admin(message):
         return
 
-    blocked_users = load_json('blocked.json')
-
-    content = str()
-    for blocked_user in blocked_users:
-        content += (f"UserID: <code>{blocked_user['UserID']}</code>\n"
-                    f"Fullname: <code>{blocked_user['Fullname']}</code>\n"
-                    f"Username: {blocked_user['Username']}\n"
-                    f"Reason: <code>{blocked_user['Reason']}</code>\n\n")
-
-    if blocked_users:
-        bot.reply_to(message, f"<b>Blocked Users</b>\n{content}", parse_mode='HTML')
-    else:
-        bot.reply_to(message, "<b>Blocked Users</b>\nThere are no blocked users yet.", parse_mode='HTML')
+    # An optional UserID or username prefix narrows the list down
+    text, markup = render_user_list('blocked', " ".join(message.text.split()[1:2]))
+    bot.reply_to(message, text, parse_mode='HTML', reply_markup=markup)
 
 
 @bot.message_handler(commands=['administrators'])
@@ -551,181 +3022,233 @@ def bot_administrators(message):
                               "/add_admin - Promote a user to admin privileges.\n"
                               "/remove_admin - Demote a user from admin privileges.\n"
                               "/text_user - Send a message to a bot user.\n"
-                              "/notify_all - Send a message to all the bot users.\n\n"
+                              "/notify_all - Send a message to all the bot users.\n"
+                              "/export_users - Export the users, admins and blocked users as JSON.\n\n"
                               "<b>Admin Commands</b>\n"
                               "/list_admins - Display the list of admins.\n"
                               "/get_id - Retrieve the user ID of a user.\n"
                               "/get_info - Retrieve the user info of a user.\n"
                               "/block_user - Block a user from using the bot.\n"
                               "/unblock_user - Unblock a user from using the bot.\n"
-                              "/blocked_users - Display the list of blocked users.", parse_mode='HTML')
+                              "/blocked_users - Display the list of blocked users.\n"
+                              "/stats - Display handler, Bot API and storage timings.\n"
+                              "/top - Display the most downloaded product codes, types and emergency files.\n"
+                              "/compact_users - Move users who blocked the bot out of the active users.",
+                     parse_mode='HTML')
+
+
+@bot.message_handler(commands=['stats'])
+def bot_stats(message):
+    if not is_user_admin(message):
+        return
+
+    def format_histograms(name, label):
+        rows = sorted(metrics.histograms(name), key=lambda row: -row[1])
+        if not rows:
+            return "Nothing recorded yet.\n"
+        return "".join(f"<code>{labels[label]}</code>: {count} calls, {total / count * 1000:.1f} ms avg, "
+                       f"p95 &lt; {p95 * 1000 if p95 else float('inf'):.0f} ms\n"
+                       for labels, count, total, p95 in rows)
+
+    errors = sorted(metrics.counters('handler_errors') + metrics.counters('api_call_errors') +
+                    metrics.counters('delivery_errors'),
+                    key=lambda row: -row[1])
+    flood_limited = sum(value for _, value in metrics.counters('api_flood_limited'))
+    inbound_dropped = sum(value for _, value in metrics.counters('inbound_dropped'))
+    inbound_muted = sum(value for _, value in metrics.counters('inbound_muted'))
+    uptime = timedelta(seconds=int(time.time() - metrics.started))
+    error_rows = "".join(f"<code>{labels.get('handler') or labels.get('method') or labels['kind']}</code> "
+                         f"{labels['error']}: {value}\n" for labels, value in errors)
+
+    text = (f"<b>Uptime:</b> {uptime}\n\n"
+            f"<b>Handlers</b>\n{format_histograms('handler', 'handler')}\n"
+            f"<b>Bot API Calls</b>\n{format_histograms('api_call', 'method')}\n"
+            f"<b>User Store Queries</b>\n{format_histograms('store_query', 'query')}\n"
+            f"<b>File Reads</b>\n{format_histograms('file_read', 'file')}\n"
+            f"<b>File Writes</b>\n{format_histograms('file_write', 'file')}\n"
+            f"<b>Deliveries</b> ({delivery.pending()} queued)\n{format_histograms('delivery', 'kind')}\n"
+            f"<b>Errors</b>\n{error_rows}"
+            f"<b>Flood limited (429):</b> {flood_limited}\n"
+            f"<b>Inbound dropped:</b> {inbound_dropped} ({inbound_muted} mutes)")
+    for part in split_message(text.splitlines(keepends=True)):
+        bot.reply_to(message, part, parse_mode='HTML')
+
+
+@bot.message_handler(commands=['top'])
+def top_downloads(message):
+    if not is_user_admin(message):
+        return
+
+    # /top [count] [days]
+    arguments = message.text.split()[1:3]
+    if not all(argument.isdigit() and int(argument) > 0 for argument in arguments):
+        bot.reply_to(message, "Please use the format /top [count] [days].")
+        return
+    limit, days = [int(argument) for argument in arguments] + [10, 7][len(arguments):]
+    days = min(days, ANALYTICS_DAILY_RETENTION)
+
+    if SHARED_STATE:
+        download_stats.reload()  # Include the downloads counted by the other workers
+
+    def format_top(kind):
+        rows = download_stats.top(kind, days, limit)
+        if not rows:
+            return "Nothing downloaded yet.\n"
+        return "".join(f"{rank}. <code>{name}</code>: {count} "
+                       f"({'+' if count >= previous else ''}{count - previous} vs previous {days} days, "
+                       f"{last_day} in the last 24 hours)\n"
+                       for rank, (name, count, previous, last_day) in enumerate(rows, 1))
+
+    text = (f"<b>Top Downloads</b> (last {days} days)\n\n"
+            f"<b>Product Codes</b>\n{format_top('code')}\n"
+            f"<b>Product Types</b>\n{format_top('type')}\n"
+            f"<b>Emergency Files</b>\n{format_top('emergency')}")
+    for part in split_message(text.splitlines(keepends=True)):
+        bot.reply_to(message, part, parse_mode='HTML')
+
+
+@bot.message_handler(commands=['compact_users'])
+def compact_users(message):
+    if not is_user_admin(message):
+        return
+
+    compacted = reachability.compact()
+    bot.reply_to(message, f"Moved {compacted} unreachable users out of the active users.\n"
+                          f"They will be restored if they message the bot again.")
 
 
 @bot.message_handler(commands=['cancel'])
+@responds
 def cancel_process(message):
-    if is_user_blocked(message):
-        return
+    blocked = blocked_response(message)
+    if blocked is not None:
+        return blocked
 
     # Clear the user's state if they are in the process
-    if message.from_user.id in user_states:
-        del user_states[message.from_user.id]
-        bot.reply_to(message, "The action has been cancelled.", reply_markup=ReplyKeyboardRemove())
+    if user_states.pop(message.from_user.id) is not None:
+        return {'text': "The action has been cancelled.", 'reply_markup': ReplyKeyboardRemove()}
     else:
-        bot.reply_to(message, "There is no ongoing action to cancel.", reply_markup=ReplyKeyboardRemove())
+        return {'text': "There is no ongoing action to cancel.", 'reply_markup': ReplyKeyboardRemove()}
 
 
-@bot.message_handler(func=lambda message: message.from_user.id in user_states and user_states[
-    message.from_user.id] == 'awaiting_product_type')
+@conversations.state('awaiting_product_type', transitions=['awaiting_product_code'])
+@responds
 def handle_product_type(message):
-    devices = load_json('devices.json')
-
-    if any(device['ProductType'] == message.text.upper() for device in devices):
-        buttons = [
-            KeyboardButton(product_codes['ProductCode'])
-            for device in devices
-            if device['ProductType'] == message.text.upper()  # Filter based on ProductType
-            for product_codes in device['ProductCodes']
-            if product_codes['DownloadID']
-        ]
-
-        if len(buttons) > 0:
-            markup = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True, row_width=2)
-            markup.add(*buttons)
-            bot.reply_to(message, "Select your Lumia product code.\nUse /cancel to cancel the action.",
-                         reply_markup=markup)
+    product_type = message.text.upper()
 
+    if catalog.device(product_type) is not None:
+        if catalog.download_codes(product_type):
             # Update the user state
-            user_states[message.from_user.id] = 'awaiting_product_code'
+            conversations.advance(message.from_user.id, 'awaiting_product_code')
+
+            return {'text': "Select your Lumia product code.\nUse /cancel to cancel the action.",
+                    'reply_markup': keyboards.get('codes', product_type)}
         else:
-            bot.reply_to(message,
-                         f"There is no firmware available in the repository for product type `{message.text}`, "
-                         f"but you can request it using /request\.",
-                         parse_mode='MarkdownV2', reply_markup=ReplyKeyboardRemove())
+            return {'text': f"There is no firmware available in the repository for product type `{message.text}`, "
+                            f"but you can request it using /request\.",
+                    'parse_mode': 'MarkdownV2', 'reply_markup': ReplyKeyboardRemove()}
 
     else:
-        bot.reply_to(message, "Please select a valid product type.\nUse /cancel to cancel the action.")
+        return {'text': "Please select a valid product type.\nUse /cancel to cancel the action."}
 
 
-@bot.message_handler(func=lambda message: message.from_user.id in user_states and user_states[
-    message.from_user.id] == 'awaiting_product_code')
+@conversations.state('awaiting_product_code')
+@responds
 def handle_product_code(message):
-    devices = load_json('devices.json')
-    if any(product_codes['ProductCode'] == message.text.upper()
-           for device in devices
-           for product_codes in device['ProductCodes']):
+    matching_device, product_code = catalog.product_code(message.text.upper())
+    if matching_device is not None:
 
         # Clear the user's state after handling the request
-        del user_states[message.from_user.id]
-
-        matching_device = [device for device in devices
-                           if any(product_codes['ProductCode'] == message.text.upper()
-                                  for product_codes in device['ProductCodes'])][0]
-
-        download_id = [
-            product_codes['DownloadID']
-            for product_codes in matching_device['ProductCodes']
-            if product_codes['ProductCode'] == message.text.upper()
-        ][0]
-
-        if len(download_id) == 1:
-            bot.copy_message(message.chat.id, FIRMWARE_CHANNEL, download_id[0], reply_to_message_id=message.message_id,
-                             protect_content=True, reply_markup=ReplyKeyboardRemove())
-        elif len(download_id) > 1:
-            msg = bot.send_message(message.chat.id, "Please wait...", reply_markup=ReplyKeyboardRemove())
-            bot.delete_message(message.chat.id, msg.message_id)
-            bot.copy_messages(message.chat.id, FIRMWARE_CHANNEL, download_id, protect_content=True)
+        user_states.pop(message.from_user.id)
+
+        download_id = product_code['DownloadID']
+
+        if download_id:
+            delivery.deliver(message.chat.id, FIRMWARE_CHANNEL, download_id, message.message_id)
+            download_stats.record('code', product_code['ProductCode'])
+            download_stats.record('type', matching_device['ProductType'])
         else:
-            bot.reply_to(message, f"There is no firmware available in the repository for "
-                                  f"product type `{matching_device['ProductType']}` with "
-                                  f"product code `{message.text}`, but you can request it using /request\.",
-                         parse_mode='MarkdownV2', reply_markup=ReplyKeyboardRemove())
-            return
+            return {'text': f"There is no firmware available in the repository for "
+                            f"product type `{matching_device['ProductType']}` with "
+                            f"product code `{message.text}`, but you can request it using /request\.",
+                    'parse_mode': 'MarkdownV2', 'reply_markup': ReplyKeyboardRemove()}
 
-        if not is_user_admin_by_id(message.from_user.id):
-            save_user_data(message.from_user)
+        save_user_data(message.from_user)
     else:
-        bot.reply_to(message, "Please select a valid product code.\nUse /cancel to cancel the action.")
+        return {'text': "Please select a valid product code.\nUse /cancel to cancel the action."}
 
 
-@bot.message_handler(func=lambda message: message.from_user.id in user_states and user_states[
-    message.from_user.id] == 'awaiting_emergency_files')
+@conversations.state('awaiting_emergency_files')
+@responds
 def handle_emergency_files(message):
-    devices = load_json('devices.json')
+    device = catalog.device(message.text.upper())
 
-    if any(device['ProductType'] == message.text.upper() for device in devices):
-        del user_states[message.from_user.id]
+    if device is not None:
+        user_states.pop(message.from_user.id)
 
-        download_id = next((device['Emergency']['DownloadID'] for device in devices
-                            if device['ProductType'] == message.text.upper()
-                            if device['Emergency']['DownloadID']), None)
+        download_id = device['Emergency']['DownloadID']
 
         if download_id:
-            bot.copy_message(message.chat.id, EMERGENCY_CHANNEL, download_id, reply_to_message_id=message.message_id,
-                             protect_content=True, reply_markup=ReplyKeyboardRemove())
+            delivery.deliver(message.chat.id, EMERGENCY_CHANNEL, [download_id], message.message_id,
+                             kind='emergency_files')
+            quotas.record(message.from_user.id, 'emergency_files')
+            download_stats.record('emergency', device['ProductType'])
         else:
-            bot.reply_to(message, f"There is no emergency flash files available in the repository "
-                                  f"for product type `{message.text}`\.",
-                         parse_mode="MarkdownV2", reply_markup=ReplyKeyboardRemove())
+            return {'text': f"There is no emergency flash files available in the repository "
+                            f"for product type `{message.text}`\.",
+                    'parse_mode': "MarkdownV2", 'reply_markup': ReplyKeyboardRemove()}
     else:
-        bot.reply_to(message, "Please select a valid product type.\nUse /cancel to cancel the action.")
+        return {'text': "Please select a valid product type.\nUse /cancel to cancel the action."}
 
 
-@bot.message_handler(content_types=['document'],
-                     func=lambda message: message.from_user.id in user_states and user_states[
-                         message.from_user.id] == 'awaiting_upload_firmware')
+@conversations.state('awaiting_upload_firmware', content_types=['document'])
+@responds
 def handle_upload_file(message):
-    """print(message.document.file_id)
-    print(message.document.file_unique_id)
-    print(message.document.file_size)
-    print(message.document.file_name)
-    print(message.document.mime_type)"""
+    problem = upload_problem(message)
+    if problem is not None:
+        return {'text': f"{problem} Please send a new one.\nUse /cancel to cancel the action."}
 
-    bot.forward_message(UPLOAD_CHANNEL, message.chat.id, message.message_id)
+    # Clear the user's state after handling the request
+    user_states.pop(message.from_user.id)
+
+    existing = upload_index.add(message.document, message.from_user.id, 'submitted')
+    if existing is None:
+        upload_review.submit(message.chat.id, message.message_id, message.document.file_unique_id)
+        return {'text': "Thank you for helping us extend the repository. "
+                        "We will review this firmware package and add it to the repository soon."}
+    elif existing['Status'] == 'published':
+        return {'text': "This firmware package is already available in the repository. Thank you anyway!"}
+    else:
+        return {'text': "This firmware package has already been submitted and is waiting for review. "
+                        "Thank you anyway!"}
 
-    if message.document.mime_type == "application/zip" and message.document.file_name.lower().endswith(".zip"):
-        # Clear the user's state after handling the request
-        del user_states[message.from_user.id]
 
-        bot.reply_to(message, "Thank you for helping us extend the repository. "
-                              "We will review this firmware package and add it to the repository soon.")
-    else:
-        bot.reply_to(message, "Sorry, the firmware package must be in ZIP format. Please send a new one.\n"
-                              "Use /cancel to cancel the action.")
+@bot.channel_post_handler(content_types=['document'],
+                          func=lambda message: message.chat.id in (FIRMWARE_CHANNEL, EMERGENCY_CHANNEL))
+def handle_published_package(message):
+    # Packages posted to the repository channels are published, so uploading them again is a duplicate
+    upload_index.add(message.document, None, 'published')
 
 
-@bot.message_handler(content_types=['text', 'document', 'photo', 'video', 'sticker', 'animation'],
-                     func=lambda message: message.from_user.id in user_states and user_states[
-                         message.from_user.id] == 'awaiting_forward_message')
+@conversations.state('awaiting_forward_message',
+                     content_types=['text', 'document', 'photo', 'video', 'sticker', 'animation'])
 def handle_forward_message(message):
-    users = load_json('users.json')
-    admins = load_json('admins.json')
+    users = user_store.all('users')
+    admins = user_store.all('admins')
 
     # Clear the user's state after handling the request
-    del user_states[message.from_user.id]
-
-    # Function to send messages
-    def send_message(target_id, source_id, content):
-        try:
-            bot.get_chat(target_id)
-            bot.copy_message(target_id, source_id, content)
-        except:
-            pass
-
-    msg = bot.send_message(message.chat.id, "Notifying users... please hold on.")
+    user_states.pop(message.from_user.id)
 
-    # Notify all users and admins
-    for target in users + admins:
-        send_message(target["UserID"], message.chat.id, message.message_id)
+    msg = bot.reply_to(message, "Notifying users... please hold on.")
 
-    bot.delete_message(message.chat.id, msg.message_id)
-    bot.reply_to(message, "All users have been notified.")
+    # Notify all users and admins in the background so this worker is free again straight away
+    Broadcast(message.chat.id, message.message_id, [target["UserID"] for target in users + admins], msg).start()
 
 
-@bot.message_handler(func=lambda message: message.from_user.id in user_states and user_states[
-    message.from_user.id] == 'awaiting_user_message')
+@conversations.state('awaiting_user_message')
 def handle_user_id(message):
     # Clear the user's state after handling the request
-    del user_states[message.from_user.id]
+    user_states.pop(message.from_user.id)
 
     if message.forward_from:
         bot.reply_to(message, f"User ID: `{message.forward_from.id}`", parse_mode='MarkdownV2')
@@ -734,5 +3257,441 @@ def handle_user_id(message):
                               "from a hidden user, or you are not forwarding a message at all.")
 
 
+# Registered after every state, so it accepts the content types of all of them
+@bot.message_handler(content_types=conversations.content_types())
+def handle_conversation(message):
+    conversations.dispatch(message)
+
+
+# Handler lists copied over to the AsyncTeleBot in async mode
+HANDLER_LISTS = ('message_handlers', 'edited_message_handlers', 'channel_post_handlers', 'callback_query_handlers',
+                 'inline_handlers')
+
+
+def keyboard_callback_action(call):
+    """Return (callback answer, keyboard page to show, selection message) for a press on a selection keyboard.
+
+    A page button sets the keyboard, a selection the message to hand to the user's state handler.
+    """
+    action, kind, version, value = call.data.split(':', 3)
+
+    if user_states.get(call.from_user.id) != KEYBOARD_KINDS.get(kind):
+        return "This selection has expired.", None, None
+
+    if action == 'kb':
+        page, _, product_type = value.partition(':')
+        if int(version) != catalog.current_version():
+            page = 0
+        return None, keyboards.get(kind, product_type or None, int(page)), None
+
+    if int(version) != catalog.current_version():
+        return "The list has been updated, please select again.", None, None
+
+    # Hand the selection to the state handler as if the user had typed it
+    message = copy.copy(call.message)
+    message.from_user = call.from_user
+    message.text = value
+    return None, None, message
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith(('kb:', 'ks:')))
+def handle_keyboard_callback(call):
+    answer, markup, selection = keyboard_callback_action(call)
+    bot.answer_callback_query(call.id, answer)
+
+    if markup is not None:
+        try:
+            bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=markup)
+        except ApiTelegramException:
+            pass  # The page did not change
+    elif selection is not None:
+        conversations.dispatch(selection)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('ul:'))
+def handle_user_list_callback(call):
+    _, kind, direction, user_id, prefix = call.data.split(':', 4)
+
+    if not acl.is_admin(call.from_user.id):
+        bot.answer_callback_query(call.id, "You do not have admin privileges to use this request.")
+        return
+
+    bot.answer_callback_query(call.id)
+    text, markup = render_user_list(kind, prefix, after=int(user_id) if direction == 'n' else None,
+                                    before=int(user_id) if direction == 'p' else None)
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='HTML',
+                              reply_markup=markup)
+    except ApiTelegramException:
+        pass  # The page did not change
+
+
+def instrument_handlers():
+    for handler_list in HANDLER_LISTS:
+        for handler in getattr(bot, handler_list):
+            function = handler['function']
+            handler['function'] = metrics.timed('handler', handler=function.__name__)(function)
+    for state, (function, content_types, transitions) in conversations.states.items():
+        conversations.states[state] = (metrics.timed('handler', handler=function.__name__)(function), content_types,
+                                       transitions)
+
+
+instrument_handlers()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT):
+    server = ThreadingHTTPServer((METRICS_LISTEN, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def run_async():
+    """Poll with AsyncTeleBot, sending the user-facing replies from the event loop.
+
+    Handlers marked with `responds`, the conversation states, the selection keyboards and inline
+    search do their catalog and store work through `asyncio.to_thread` and await their Bot API
+    calls on the event loop, so a conversation only holds a thread while it touches the store,
+    never while it waits on Telegram. The admin commands, which are rare and send several
+    messages, still run on a bounded executor with the sync bot.
+    """
+    import asyncio
+    from telebot import asyncio_helper, asyncio_handler_backends
+    from telebot.async_telebot import AsyncTeleBot
+
+    if BOT_API_URL:
+        asyncio_helper.API_URL = BOT_API_URL
+
+    async_bot = AsyncTeleBot(API_TOKEN)
+    instrument_api_methods(async_bot)
+
+    class AsyncInboundFloodMiddleware(asyncio_handler_backends.BaseMiddleware):
+        def __init__(self):
+            super().__init__()
+            self.update_types = INBOUND_UPDATE_TYPES
+
+        async def pre_process(self, update, data):
+            if inbound_flooded(update):
+                if isinstance(update, CallbackQuery):
+                    try:
+                        await async_bot.answer_callback_query(update.id, INBOUND_DROPPED_ANSWER)
+                    except Exception:
+                        pass
+                return asyncio_handler_backends.CancelUpdate()
+
+        async def post_process(self, update, data, exception):
+            pass
+
+    if INBOUND_RATE > 0:
+        async_bot.setup_middleware(AsyncInboundFloodMiddleware())
+    executor = ThreadPoolExecutor(max_workers=ASYNC_WORKERS, thread_name_prefix='handler')
+
+    async def send(message, response):
+        if response is None:
+            return
+        options = dict(response)
+        text = options.pop('text')
+        if options.pop('quote', True):
+            await async_bot.reply_to(message, text, **options)
+        else:
+            await async_bot.send_message(message.chat.id, text, **options)
+
+    def as_coroutine(function):
+        if hasattr(function, 'respond'):
+            async def respond(update):
+                await send(update, await asyncio.to_thread(function.respond, update))
+            respond.__name__ = function.__name__
+            return metrics.timed('handler', handler=function.__name__)(respond)
+
+        # Sync handlers are already timed by instrument_handlers
+        async def handler(update):
+            await asyncio.get_running_loop().run_in_executor(executor, function, update)
+        return handler
+
+    states = {state: as_coroutine(function) for state, (function, _, _) in conversations.states.items()}
+
+    async def dispatch(message):
+        state = await asyncio.to_thread(conversations.accepting_state, message)
+        if state is not None:
+            await states[state](message)
+
+    async def keyboard_callback(call):
+        answer, markup, selection = await asyncio.to_thread(keyboard_callback_action, call)
+        await async_bot.answer_callback_query(call.id, answer)
+
+        if markup is not None:
+            try:
+                await async_bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id,
+                                                          reply_markup=markup)
+            except asyncio_helper.ApiTelegramException:
+                pass  # The page did not change
+        elif selection is not None:
+            await dispatch(selection)
+
+    async def inline_search(query):
+        await async_bot.answer_inline_query(query.id, await asyncio.to_thread(inline_search_results, query),
+                                            cache_time=300)
+
+    native = {handle_conversation: dispatch, handle_keyboard_callback: keyboard_callback,
+              handle_inline_search: inline_search}
+
+    for handler_list in HANDLER_LISTS:
+        for handler in getattr(bot, handler_list):
+            function = handler['function']
+            original = getattr(function, '__wrapped__', function)
+            if original in native:
+                coroutine = metrics.timed('handler', handler=original.__name__)(native[original])
+            else:
+                coroutine = as_coroutine(function)
+            getattr(async_bot, handler_list).append(dict(handler, function=coroutine))
+
+    for listener in bot.update_listener:
+        async def run_listener(messages, listener=listener):
+            await asyncio.to_thread(listener, messages)
+        async_bot.set_update_listener(run_listener)
+
+    asyncio.run(async_bot.infinity_polling())
+
+
+def update_partition_key(update):
+    """Key updates by the user they come from, so one user's updates always land on the same worker."""
+    for update_type in ('message', 'edited_message', 'callback_query', 'inline_query'):
+        content = getattr(update, update_type, None)
+        if content is not None and content.from_user is not None:
+            return content.from_user.id
+    return update.update_id
+
+
+class UpdateWorkerPool:
+    """Fixed set of worker threads, each draining its own bounded queue.
+
+    Updates are partitioned by `update_partition_key`, so the updates of a single user are
+    handled one at a time and in the order they arrived.
+    """
+
+    def __init__(self, workers, queue_size, process=None):
+        self.process = process or (lambda update: bot.process_new_updates([update]))
+        self.queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self.threads = [threading.Thread(target=self._work, args=(update_queue,), daemon=True)
+                        for update_queue in self.queues]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, update, raw=None, block=False):
+        """Queue an update, returning False if its worker's queue is full and `block` is not set."""
+        try:
+            self.queues[update_partition_key(update) % len(self.queues)].put(update, block=block)
+            return True
+        except queue.Full:
+            return False
+
+    def join(self):
+        """Wait until every queued update has been handled."""
+        for update_queue in self.queues:
+            update_queue.join()
+
+    def _work(self, update_queue):
+        while True:
+            update = update_queue.get()
+            try:
+                self.process(update)
+            except Exception as e:
+                print(f"Failed to process update {update.update_id}: {e}")
+            finally:
+                update_queue.task_done()
+
+
+class ClusterRouter:
+    """Runs this script as `workers` worker processes and hands each update to one of them.
+
+    Updates are partitioned by `update_partition_key`, so a user's updates always reach the same
+    worker, in order. Each is written as one line of JSON to its worker's stdin, and a worker
+    that has exited is started again on the next update routed to it.
+    """
+
+    def __init__(self, workers):
+        self.processes = [self._spawn(index, workers) for index in range(workers)]
+        self._locks = [threading.Lock() for _ in range(workers)]
+
+    @staticmethod
+    def _spawn(index, workers):
+        environment = dict(os.environ, BOT_MODE='worker', WORKER_INDEX=str(index), WORKER_COUNT=str(workers))
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdin=subprocess.PIPE, env=environment)
+
+    def submit(self, update, raw=None, block=False):
+        """Send an update to its worker, returning False if the worker could not take it."""
+        if raw is None:
+            return False
+        index = update_partition_key(update) % len(self.processes)
+
+        with self._locks[index]:
+            if self.processes[index].poll() is not None:
+                print(f"Worker {index} exited with {self.processes[index].returncode}, restarting it")
+                self.processes[index] = self._spawn(index, len(self.processes))
+            try:
+                # JSON never needs a raw line break, so one update always fits on one line
+                self.processes[index].stdin.write(raw.replace(b'\r', b' ').replace(b'\n', b' ') + b'\n')
+                self.processes[index].stdin.flush()
+                return True
+            except OSError as e:
+                print(f"Failed to hand update {update.update_id} to worker {index}: {e}")
+                return False
+
+    def close(self):
+        """Let the workers finish the updates they were given and wait for them to exit."""
+        for process in self.processes:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+        for process in self.processes:
+            process.wait()
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    worker_pool = None
+    update_log = None
+    update_log_lock = threading.Lock()
+
+    def do_GET(self):
+        # Health check for load balancers
+        self._respond(200)
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self._respond(404)
+            return
+
+        if not hmac.compare_digest(self.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), WEBHOOK_SECRET):
+            self._respond(403)
+            return
+
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            update = telebot.types.Update.de_json(body.decode('utf-8'))
+            # Updates without a sender are partitioned by update_id, so it has to be a real integer
+            if type(update.update_id) is not int:
+                raise ValueError(f"Invalid update_id {update.update_id!r}")
+        except (ValueError, KeyError, TypeError):
+            self._respond(400)
+            return
+
+        if self.update_log is not None:
+            with self.update_log_lock:
+                self.update_log.write(body.replace(b'\r', b' ').replace(b'\n', b' ') + b'\n')
+                self.update_log.flush()
+
+        # Telegram redelivers the update later when we answer with an error
+        self._respond(200 if self.worker_pool.submit(update, body) else 503)
+
+    def _respond(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_webhook(worker_pool):
+    WebhookRequestHandler.worker_pool = worker_pool
+    if UPDATE_LOG:
+        # Recorded updates can be replayed against a cluster with CLUSTER_REPLAY
+        WebhookRequestHandler.update_log = open(UPDATE_LOG, 'ab')
+
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+
+    ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookRequestHandler).serve_forever()
+
+
+def require_webhook_secret():
+    # Without it anyone who can reach the port could post updates in the name of any user, admins included
+    if not WEBHOOK_SECRET:
+        raise ValueError("Serving the webhook needs WEBHOOK_SECRET, the token Telegram sends with every update")
+
+
+def run_webhook():
+    """Serve Telegram updates over a webhook, handled by a pool of ordered update workers."""
+    require_webhook_secret()
+    # The worker pool does the threading; the bot handles each update inline on the worker
+    bot.threaded = False
+
+    worker_pool = UpdateWorkerPool(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+    worker_pool.start()
+    serve_webhook(worker_pool)
+
+
+def run_cluster():
+    """Front process: route updates to CLUSTER_WORKERS worker processes by user ID.
+
+    Updates come from the webhook, or from the recorded update stream in CLUSTER_REPLAY, one JSON
+    update per line, in which case the front exits once the workers have handled all of them.
+    """
+    if not CLUSTER_REPLAY:
+        require_webhook_secret()
+    router = ClusterRouter(CLUSTER_WORKERS)
+
+    if CLUSTER_REPLAY:
+        with open(CLUSTER_REPLAY, 'rb') as update_stream:
+            for line in update_stream:
+                if line.strip():
+                    router.submit(telebot.types.Update.de_json(line.decode('utf-8')), line.rstrip(b'\r\n'))
+        router.close()
+        return
+
+    atexit.register(router.close)
+    serve_webhook(router)
+
+
+def run_worker():
+    """Cluster worker: handle the updates the front process writes to stdin, one JSON update per line."""
+    bot.threaded = False
+
+    worker_pool = UpdateWorkerPool(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+    worker_pool.start()
+
+    for line in sys.stdin.buffer:
+        if line.strip():
+            worker_pool.submit(telebot.types.Update.de_json(line.decode('utf-8')), block=True)
+
+    # The front process closed the stream; finish what was already given to us before exiting
+    worker_pool.join()
+    delivery.wait_idle(timeout=60)
+
+
 # Start polling
-bot.infinity_polling()
+if __name__ == '__main__':
+    # Exit through atexit on SIGTERM too, so pending writes get flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if METRICS_PORT:
+        # Cluster workers take the ports after the front process's
+        start_metrics_server(METRICS_PORT + WORKER_INDEX + 1 if BOT_MODE == 'worker' else METRICS_PORT)
+
+    print("bot started running" if BOT_MODE != 'worker' else f"worker {WORKER_INDEX} started running")
+
+    if BOT_MODE == 'async':
+        run_async()
+    elif BOT_MODE == 'webhook':
+        run_webhook()
+    elif BOT_MODE == 'cluster':
+        run_cluster()
+    elif BOT_MODE == 'worker':
+        run_worker()
+    else:
+        bot.infinity_polling()